@@ -8,7 +8,7 @@ setup(name='strkernel',
       classifiers=[
           'Development Status :: 3 - Alpha',
           'License :: OSI Approved :: MIT License',
-          'Programming Language :: Python :: 3.6',
+          'Programming Language :: Python :: 3.7',
           'Topic :: Text Processing',
       ],
       keywords='string kernel SVM machine learning',
@@ -18,9 +18,10 @@ setup(name='strkernel',
       test_suite='nose.collector',
       tests_require=['nose'],
       packages=find_packages(),
+      python_requires='>=3.7',
       install_requires=[
         'scipy',
-        'numpy',
+        'numpy>=1.20',
         'Biopython'
       ],
       include_package_data=True,
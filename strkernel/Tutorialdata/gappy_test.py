@@ -11,18 +11,14 @@ from sklearn.metrics import roc_curve, roc_auc_score
 from sklearn.metrics import average_precision_score
 from sklearn.metrics import precision_recall_curve, precision_score
 from scipy.sparse import hstack, vstack
+from strkernel.lib.fasta import read_sequences
 import sys
 
 
 
 # Reads in files
 def read(fname):
-    sequences=[]
-    with open(fname,'r') as f:
-        for line in f:
-            if line[0]!='>':
-                sequences.append(line.split()[0])
-    return sequences
+    return read_sequences(fname)
 
 # Test how fast the matrix is constructed
 def speedMatrix(pos,neg,k,g,got_time=False):
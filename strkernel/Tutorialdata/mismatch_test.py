@@ -7,8 +7,7 @@ Created on July 10, 2018
 from mismatch_kernel import MismatchKernel
 from mismatch_kernel import preprocess
 
-from Bio import SeqIO
-from Bio.Seq import Seq
+from strkernel.lib.fasta import read_sequences
 from sklearn.svm import SVC
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import roc_curve, auc, precision_recall_curve, average_precision_score
@@ -20,8 +19,8 @@ from timeit import default_timer as timer
 
 
 # load the data
-posSeq = [seq.seq for seq in SeqIO.parse('/notebook_data/positive_IGF2BP123.fasta', 'fasta')]
-negSeq = [seq.seq for seq in SeqIO.parse('/notebook_data/negative_IGF2BP123.fasta', 'fasta')]
+posSeq = read_sequences('/notebook_data/positive_IGF2BP123.fasta')
+negSeq = read_sequences('/notebook_data/negative_IGF2BP123.fasta')
 
 # a quick check by randomly opting 1000 positive sequences 
 # and 1000 negative sequneces to save running time
@@ -32,29 +31,31 @@ negX = preprocess(random.choice(negSeq, 1000))
 posY = np.ones(len(posX), dtype=int)
 negY = np.zeros(len(negX), dtype=int)
 
-start = timer()
-
-# (5,1)-mismatch kernel
-posKernels = MismatchKernel(l=4, k=5, m=1).get_kernel(posX).kernel
-negKernels = MismatchKernel(l=4, k=5, m=1).get_kernel(negX).kernel
-
-end = timer()
-print("Time used to compute kernels:", end-start)
-
 # merge data
-X = np.concatenate([posKernels,negKernels])
+X = posX + negX
 y = np.concatenate([posY,negY])
 
 # split training and test data, choose 30% as test data. 
 X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.30)
 
-clf = SVC()
-clf.fit(X_train, y_train)
+start = timer()
+
+# (5,1)-mismatch kernel of the training sequences and
+# the kernel between test and training sequences
+mismatch_kernel = MismatchKernel(l=4, k=5, m=1).get_kernel(X_train)
+train_kernel = mismatch_kernel.kernel
+test_kernel = mismatch_kernel.get_test_kernel(X_test)
+
+end = timer()
+print("Time used to compute kernels:", end-start)
+
+clf = SVC(kernel='precomputed')
+clf.fit(train_kernel, y_train)
 
-y_true, y_pred = y_test, clf.predict(X_test)
+y_true, y_pred = y_test, clf.predict(test_kernel)
 print(classification_report(y_true, y_pred))
 
-y_score = clf.decision_function(X_test)
+y_score = clf.decision_function(test_kernel)
 
 '''Plots a roc curve including a baseline'''
 # compute true positive rate and false positive rate
@@ -2,15 +2,19 @@
 '''
 Implementation of the gappy kernel.
 '''
+from functools import lru_cache
+
 import numpy as np
 import scipy
 from Bio.Seq import Seq
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
 
+from strkernel.lib.cache import cached
+from strkernel.lib.encoding import UNKNOWN, alphabets, encode, sequenceTypes
+from strkernel.lib.featurestore import FeatureStore
+from strkernel.lib.hashing import hash_features
+from strkernel.lib.parallel import map_chunks
 
-sequenceTypes={'dna':0,'rna':1,'aa':2,'aa+s':3}
-# DNA/RNA, Amino acids (all 20), Amino acids selenocystein
-alphabets=['ACGT','ACGU','ACDEFGHIKLMNPQRSTVWY','ACDEFGHIKLMNPQRSTUVWY']
 
 def get_numbers_for_sequence(sequence,t=0,reverse=False):
     try:
@@ -24,6 +28,132 @@ def get_numbers_for_sequence(sequence,t=0,reverse=False):
     return ori
 
 
+@lru_cache(maxsize=None)
+def _get_complement(t=0):
+    """Return the code of the complement of every letter of the alphabet
+    (-1 if the complement is not part of the alphabet). The map is built once
+    per alphabet and is read-only."""
+    if t == sequenceTypes['rna']:
+        complement = np.array([alphabets[t].find(str(Seq(x.replace('U', 'T')).complement()).replace('T', 'U')) for x in alphabets[t]])
+    else:
+        complement = np.array([alphabets[t].find(str(Seq(x).complement())) for x in alphabets[t]])
+    complement.flags.writeable = False
+    return complement
+
+def _encode_kmers(sequence, k, t=0, reverse=False):
+    """Compute the spectrum position of every k-mer of a sequence at once.
+    The sequence is encoded only once and the positions are computed as the
+    dot product of all sliding windows with the exponents of the alphabet size.
+    Returns the positions of the k-mers, the positions of their reverse
+    complements (read in the opposite direction, so they can be combined to
+    the reverse complement of a 2*k-mer) or None and a mask of k-mers that
+    contain characters that are not part of the alphabet.
+    """
+    alphabet = len(alphabets[t])
+    codes = encode(sequence, t)
+    if len(codes) < k:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, (empty if reverse else None), np.zeros(0, dtype=bool)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    invalid = (windows == UNKNOWN).any(axis=1)
+    windows = np.where(windows == UNKNOWN, 0, windows).astype(np.int64)
+    forward = windows @ np.power(alphabet, range(k))[::-1]
+    backward = None
+    if reverse:
+        complement = _get_complement(t)[windows]
+        invalid |= (complement < 0).any(axis=1)
+        backward = np.where(complement < 0, 0, complement) @ np.power(alphabet, range(k))
+    return forward, backward, invalid
+
+def _pair_halves(kmers, k, gap, count):
+    """Return the positions of the left and the right k-mer of the first
+    count 2*k-mers with the given gap from the k-mer positions returned by
+    _encode_kmers, and a mask of the 2*k-mers with unknown characters.
+    Like get_numbers_for_sequence, the smaller of a 2*k-mer and its reverse
+    complement is used.
+    """
+    forward, backward, invalid = kmers
+    right = slice(k + gap, k + gap + count)
+    left_half, right_half = forward[:count], forward[right]
+    if backward is not None:
+        # the reverse complement of a pair reads the right k-mer first
+        reverse_left, reverse_right = backward[right], backward[:count]
+        use_reverse = (reverse_left < left_half) | ((reverse_left == left_half) & (reverse_right < right_half))
+        left_half = np.where(use_reverse, reverse_left, left_half)
+        right_half = np.where(use_reverse, reverse_right, right_half)
+    return left_half, right_half, invalid[:count] | invalid[right]
+
+def _pair_positions(kmers, k, t, gap, count):
+    """Compute the spectrum positions of the first count 2*k-mers with the
+    given gap from the k-mer positions returned by _encode_kmers.
+    2*k-mers with unknown characters are mapped to the (negative) position
+    of [-1], like get_numbers_for_sequence does.
+    """
+    left_half, right_half, invalid = _pair_halves(kmers, k, gap, count)
+    positions = left_half * np.power(len(alphabets[t]), k) + right_half
+    positions[invalid] = -np.sum(np.power(len(alphabets[t]), range(2 * k)))
+    return positions
+
+def _hashed_positions(sequence, k, g, t=0, reverse=False, gapDifferent=True, n_features=2**20):
+    """Return the buckets and signs of all (gappy) k-mers of a sequence when
+    they are hashed into n_features buckets. The k-mers are the same as the
+    ones of the explicit spectrum chosen by gappypair_kernel. The key of a
+    2*k-mer consists of its two k-mer halves and its gap (if gapDifferent),
+    so it is never combined into one, possibly overflowing, integer.
+    k-mers with unknown characters share the key (-1, -1, gap).
+    """
+    kmers = _encode_kmers(sequence, k, t, reverse)
+    if g == 0:
+        forward, backward, invalid = kmers
+        left_half = forward if backward is None else np.minimum(forward, backward)
+        left_half[invalid] = -1
+        return hash_features(left_half, np.zeros_like(left_half), 0, n_features)
+    n = len(sequence)
+    halves = []
+    for gap in range(g+1):
+        # as in the explicit spectrum, with gapDifferent gapped 2*k-mers are
+        # only counted where the largest gap still fits
+        count = max(n - 2*k - (g if gapDifferent and gap > 0 else gap) + 1, 0)
+        left_half, right_half, invalid = _pair_halves(kmers, k, gap, count)
+        left_half[invalid] = right_half[invalid] = -1
+        halves.append((left_half, right_half, np.full(count, gap if gapDifferent else 0)))
+    return hash_features(*[np.concatenate(x) for x in zip(*halves)], n_features)
+
+def _gappy_positions(sequence, k, g, t=0, reverse=False):
+    """Return the positions of all 2*k-mers with gaps up to g in the
+    gappypair-spectrum of _extract_gappy_sequence and the spectrum size.
+    """
+    n = len(sequence)
+    kk=2*k
+    powersize=np.power(len(alphabets[t]), (kk))
+    kmers = _encode_kmers(sequence, k, t, reverse)
+    positions = [_pair_positions(kmers, k, t, gap, max(n - kk - gap + 1, 0)) for gap in range(g+1)]
+    return np.concatenate(positions) % powersize, powersize
+
+def _spectrum_positions(sequence, k, t=0, reverse=False):
+    """Return the positions of all k-mers in the k-spectrum of
+    _extract_spectrum_sequence and the spectrum size.
+    """
+    alphabet=len(alphabets[t])
+    powersize = np.power(alphabet, k)
+    forward, backward, invalid = _encode_kmers(sequence, k, t, reverse)
+    positions = forward if backward is None else np.minimum(forward, backward)
+    positions[invalid] = -np.sum(np.power(alphabet, range(k)))
+    return positions % powersize, powersize
+
+def _gappy_positions_different(sequence, k, g, t=0, reverse=False):
+    """Return the positions of all 2*k-mers with gaps up to g in the
+    gappypair-spectrum of _extract_gappy_sequence_different and the spectrum size.
+    """
+    n = len(sequence)
+    kk=2*k
+    powersize=np.power(len(alphabets[t]), (kk))
+    kmers = _encode_kmers(sequence, k, t, reverse)
+    # gapped 2*k-mers are only counted where the largest gap still fits
+    positions = [_pair_positions(kmers, k, t, 0, max(n - kk + 1, 0))]
+    positions += [(gap*(powersize)) + _pair_positions(kmers, k, t, gap, max(n - kk - g + 1, 0)) for gap in range(1,g+1)]
+    return np.concatenate(positions) % ((g+1)*powersize), (g+1)*powersize
+
 def _extract_gappy_sequence(sequence, k, g,t=0,reverse=False):
     """Compute gappypair-spectrum for a given sequence, k-mer length k and
     gap length g. A 2*k-mer with gap is saved at the same position as a 2*k-mer
@@ -35,20 +165,8 @@ def _extract_gappy_sequence(sequence, k, g,t=0,reverse=False):
     containing the exponents of 4 to calculate the position in the spectrum.
     Example: AUUC -> 0331 -> 4**0*1 + 4**1*3 + 4**2*3 + 4**3*0
     """
-    n = len(sequence)
-    kk=2*k
-    alphabet=len(alphabets[t])
-    powersize=np.power(alphabet, (kk))
-    multiplier = np.power(alphabet, range(kk))[::-1]
-    spectrum = np.zeros((powersize))
-    for pos in range(n - kk + 1):
-            pos_in_spectrum = np.sum(multiplier * get_numbers_for_sequence(sequence[pos:pos+(kk)],t,reverse=reverse))
-            spectrum[pos_in_spectrum] += 1
-            for gap in range(1,g+1):
-                if (pos+gap+kk)<=n:
-                    pos_gap = np.sum(multiplier * get_numbers_for_sequence(sequence[pos:pos+k] + sequence[pos+k+gap:pos+gap+kk],t,reverse=reverse))
-                    spectrum[pos_gap] += 1
-    return spectrum
+    positions, size = _gappy_positions(sequence, k, g, t, reverse)
+    return np.bincount(positions, minlength=size).astype(float)
 
 def _extract_spectrum_sequence(sequence, k,t=0,reverse=False):
     """Compute k-spectrum for a given sequence, k-mer length k.
@@ -60,36 +178,87 @@ def _extract_spectrum_sequence(sequence, k,t=0,reverse=False):
     containing the exponents of 4 to calculate the position in the spectrum.
     Example: AUUC -> 0331 -> 4**0*1 + 4**1*3 + 4**2*3 + 4**3*0
     """
-    n = len(sequence)
-    alphabet=len(alphabets[t])
-    spectrum = np.zeros(np.power(alphabet, k))
-    multiplier = np.power(alphabet, range(k))[::-1]
-    for pos in range(n - k + 1):
-            pos_in_spectrum = np.sum(multiplier * get_numbers_for_sequence(sequence[pos:pos+k],t,reverse))
-            spectrum[pos_in_spectrum] += 1
-    return spectrum
+    positions, size = _spectrum_positions(sequence, k, t, reverse)
+    return np.bincount(positions, minlength=size).astype(float)
 
 def _extract_gappy_sequence_different(sequence, k, g,t=0,reverse=False):
     """Compute gappypair-spectrum for a given sequence, k-mer length k and
     gap length g. A 2*k-mer with a certain gap size is saved at a different
     position than the same 2*k-mer with no gaps or another number of gaps.
     """
-    n = len(sequence)
-    kk=2*k
-    alphabet=len(alphabets[t])
-    powersize=np.power(alphabet, (kk))
-    multiplier = np.power(alphabet, range(kk))[::-1]
-    spectrum = np.zeros((g+1)*(powersize))
-    for pos in range(n - kk + 1):
-            pos_in_spectrum = np.sum(multiplier * get_numbers_for_sequence(sequence[pos:pos+(kk)],t,reverse=reverse))
-            spectrum[pos_in_spectrum] += 1
-            if (pos+g+kk)<=n:
-                for gap in range(1,g+1):
-                    pos_gap = np.sum(multiplier * get_numbers_for_sequence(sequence[pos:pos+k] + sequence[pos+k+gap:pos+gap+kk],t,reverse=reverse))
-                    spectrum[(gap*(powersize))+pos_gap] += 1
-    return spectrum
-
-def gappypair_kernel(sequences, k, g=0,t=0,sparse=True, reverse=False, include_flanking=False, gapDifferent = True):
+    positions, size = _gappy_positions_different(sequence, k, g, t, reverse)
+    return np.bincount(positions, minlength=size).astype(float)
+
+def _prepare_sequence(seq, include_flanking=False):
+    """Upper-case the flanking regions of a sequence or remove them."""
+    if include_flanking:
+        return seq.upper()
+    return Seq("".join([x for x in seq if 'A' <= x <= 'Z']))
+
+def _get_features(seq, k, g=0, t=0, reverse=False, gapDifferent=True, n_features=None):
+    """Return the columns of all k-mers of a prepared sequence and the value
+    they add (1, or the sign if the k-mers are hashed into n_features
+    buckets), choosing the spectrum the same way as gappypair_kernel.
+    """
+    if n_features is not None:
+        return _hashed_positions(seq, k, g, t, reverse, gapDifferent, n_features)
+    if (g>0) and gapDifferent:
+        positions, _ = _gappy_positions_different(seq, k, g, t = t, reverse = reverse)
+    elif g>0:
+        positions, _ = _gappy_positions(seq, k, g, t = t, reverse = reverse)
+    else:
+        positions, _ = _spectrum_positions(seq, k, t = t, reverse = reverse)
+    return positions, np.ones(len(positions), dtype=np.int64)
+
+def _spectrum_size(k, g=0, t=0, gapDifferent=True, n_features=None):
+    """Return the number of columns of the spectrum chosen by gappypair_kernel."""
+    if n_features is not None:
+        return n_features
+    if (g>0) and gapDifferent:
+        return (g+1)*np.power(len(alphabets[t]), 2*k)
+    elif g>0:
+        return np.power(len(alphabets[t]), 2*k)
+    return np.power(len(alphabets[t]), k)
+
+def _sparse_spectrum(sequences, k, g=0, t=0, reverse=False, include_flanking=False, gapDifferent=True, n_features=None):
+    """Build the sparse gappypair-spectrum of a set of sequences directly from
+    (row, column, count) triples, without allocating a dense spectrum per
+    sequence. Memory therefore only scales with the number of distinct k-mers
+    that occur in the sequences.
+    """
+    columns = []
+    counts = []
+    indptr = np.zeros(len(sequences) + 1, dtype=np.int64)
+    for row, seq in enumerate(sequences):
+        positions, values = _get_features(_prepare_sequence(seq, include_flanking), k, g, t, reverse, gapDifferent, n_features)
+        column, inverse = np.unique(positions, return_inverse=True)
+        count = np.bincount(inverse.ravel(), weights=values, minlength=len(column)).astype(np.int32)
+        # hashed k-mers with opposite signs can cancel each other out
+        column, count = column[count != 0], count[count != 0]
+        columns.append(column.astype(np.int64))
+        counts.append(count)
+        indptr[row + 1] = indptr[row] + len(column)
+    data = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int32)
+    indices = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+    return csr_matrix((data, indices, indptr), shape=(len(sequences), _spectrum_size(k, g, t, gapDifferent, n_features)))
+
+def _dense_spectrum(sequences, k, g=0, t=0, reverse=False, include_flanking=False, gapDifferent=True, n_features=None):
+    """Compute the dense gappypair-spectrum of a set of sequences."""
+    spectrum = []
+    for seq in sequences:
+        seq = _prepare_sequence(seq, include_flanking)
+        if n_features is not None:
+            buckets, signs = _hashed_positions(seq, k, g, t, reverse, gapDifferent, n_features)
+            spectrum.append(np.bincount(buckets, weights=signs, minlength=n_features))
+        elif (g>0) and gapDifferent:
+            spectrum.append(_extract_gappy_sequence_different(seq, k, g, t = t, reverse = reverse))
+        elif g>0:
+            spectrum.append(_extract_gappy_sequence(seq, k, g, t = t, reverse = reverse))
+        else:
+            spectrum.append(_extract_spectrum_sequence(seq, k, t = t, reverse = reverse))
+    return np.array(spectrum)
+
+def gappypair_kernel(sequences, k, g=0,t=0,sparse=True, reverse=False, include_flanking=False, gapDifferent = True, n_jobs=1, n_features=None, cache=None):
     """Compute gappypair-kernel for a set of sequences using k-mer length k
     and gap size g. The result than can be used in a linear SVM or other
     classification algorithms.
@@ -101,6 +270,8 @@ def gappypair_kernel(sequences, k, g=0,t=0,sparse=True, reverse=False, include_f
     t:                      Which alphabet according to sequenceTypes.
                             Assumes Dna (t=0).
     sparse:                 Boolean. Output as sparse matrix? True by default.
+                            The sparse matrix is built directly from the
+                            k-mers found and contains integer counts.
     reverse:                Boolean. Reverse complement taken into account?
                             False by default.
     include_flanking:       Boolean. Include flanking regions?
@@ -108,23 +279,48 @@ def gappypair_kernel(sequences, k, g=0,t=0,sparse=True, reverse=False, include_f
     gapDifferent:           Boolean. If k-mers with different gaps should be
                             threated differently or all the same.
                             True by default.
+    n_jobs:                 Integer. Number of worker processes the sequences
+                            are split across. -1 uses all cpus. 1 by default.
+    n_features:             Integer. If given, the k-mers are hashed into
+                            n_features columns with signed hashing instead of
+                            using the explicit spectrum. None by default.
+    cache:                  A strkernel.lib.cache.Cache or the path of its
+                            directory. If given, the result is loaded from
+                            the cache when it was computed for the same
+                            sequences and parameters before. None by default.
     Returns:
     -------
     A numpy array of shape (N, 4**k), containing the k-spectrum for each
     sequence. N is the number of sequences and k the length of k-mers considered.
     """
-    spectrum = []
-    for seq in sequences:
-        if include_flanking:
-            seq = seq.upper()
-        else:
-            seq = Seq("".join([x for x in seq if 'A' <= x <= 'Z']))
-        if (g>0) and gapDifferent:
-            spectrum.append(_extract_gappy_sequence_different(seq, k, g, t = t, reverse = reverse))
-        elif g>0:
-            spectrum.append(_extract_gappy_sequence(seq, k, g, t = t, reverse = reverse))
-        else:
-            spectrum.append(_extract_spectrum_sequence(seq, k, t = t, reverse = reverse))
-    if sparse:
-        return csr_matrix(spectrum)
-    return np.array(spectrum)
+    args = (k, g, t, reverse, include_flanking, gapDifferent, n_features)
+    def compute():
+        if sparse:
+            return vstack(map_chunks(_sparse_spectrum, sequences, n_jobs, args), format='csr')
+        blocks = map_chunks(_dense_spectrum, sequences, n_jobs, args)
+        return blocks[0] if len(blocks) == 1 else np.vstack(blocks)
+    return cached(cache, compute, 'gappy_kernel.gappypair_kernel', sequences, k=k, g=g, t=t, sparse=sparse,
+                  reverse=reverse, include_flanking=include_flanking, gapDifferent=gapDifferent, n_features=n_features)
+
+def gappypair_stream(batches, store, k, g=0, t=0, reverse=False, include_flanking=False, gapDifferent = True, n_jobs=1, n_features=None):
+    """Compute the sparse gappypair-spectrum of sequences that are given in
+    batches, for example by strkernel.lib.fasta.iter_sequences, and append
+    it to a FeatureStore on disk batch by batch. Only one batch is kept in
+    memory at a time.
+    Parameters:
+    ----------
+    batches:                An iterable of lists of sequences
+    store:                  A FeatureStore or the path of its directory.
+                            The rows are appended to the rows it contains.
+    k, g, t, reverse, include_flanking, gapDifferent, n_jobs, n_features:
+                            See gappypair_kernel.
+    Returns:
+    -------
+    The FeatureStore, with the document frequency of every k-mer and the
+    norm of every sequence.
+    """
+    if not isinstance(store, FeatureStore):
+        store = FeatureStore(store, _spectrum_size(k, g, t, gapDifferent, n_features))
+    return store.extend(gappypair_kernel(batch, k, g, t, sparse=True, reverse=reverse, include_flanking=include_flanking,
+                                         gapDifferent=gapDifferent, n_jobs=n_jobs, n_features=n_features)
+                        for batch in batches)
@@ -2,125 +2,245 @@
 '''
 Trie Implementation
 ---
-Class that includes the construction of a trie based on a set of strings
-and a prefix search function.
+Construction of a trie based on a set of strings by a depth-first search.
+The trie is never stored: a node only exists while it is on the stack of
+the search, as the flat arrays of the occurrences of its kmer.
 '''
 import numpy as np
 import scipy
-import itertools
 from scipy.sparse import coo_matrix
 from Bio.Seq import Seq
 import time
 import concurrent.futures
 
-sequenceTypes={'dna':0,'rna':1,'aa':2,'aa+s':3}
-# DNA/RNA, Amino acids (all 20), Amino acids selenocystein
-alphabets=['ACGT','ACGU','ACDEFGHIKLMNPQRSTVWY','ACDEFGHIKLMNPQRSTUVWY']
-s=np.array([np.arange(4),np.arange(4),np.arange(20),np.arange(21)])
+from strkernel.lib.cache import cached
+from strkernel.lib.encoding import UNKNOWN, Sequences, alphabets, as_sequences, encode_batch, sequenceTypes
+from strkernel.lib.hashing import hash_features
+from strkernel.lib.parallel import get_n_jobs, map_chunks
 
-class TrieNode:
+s=[np.arange(4),np.arange(4),np.arange(20),np.arange(21)]
+
+
+class Vocabulary:
     """
-    Implementation of a trie node.
+    Fixed assignment of columns to the leaves (kmer and gap) of the trie, so
+    that the matrices of different sets of sequences share their columns.
+    A leaf is identified by its canonical index, the position of the kmer and
+    gap in the full spectrum. An empty vocabulary is filled with the leaves
+    of the first sequences it is used for; leaves of later sequences that are
+    not part of the vocabulary are ignored. Since the leaves are sorted like
+    they are visited, the first matrix equals the one computed without
+    a vocabulary. The canonical indices depend on k, t, g and gapDifferent,
+    so the vocabulary remembers them and can only be used with the same ones.
     """
-    # Char is a number
-    def __init__(self, char):
-        self._char = char
-        self._children = []
-        # list of tuples: (seq number, pos of kmer, last seen pos in kmer)
-        self._q=[]
-
-    def __repr__(self):
-        return self._char
-
-def get_sparse(g,k,t,sequences,gap_pos,gapDifferent):
-    s=[[],[],[]]
-    root=TrieNode('*')
-    # Initialization of all possible kmers
-    root._q = np.array(list(itertools.chain.from_iterable([[(i,j,0) for j in range(sequences[i].size-k+1)] for i in range(sequences.shape[0])])))
-    dfs(root,s,sequences,t,k,g,0,gap_pos,gapDifferent)
-    return coo_matrix((np.int_(s[0]),(np.int_(s[1]),np.int_(s[2][1:]))))
-
-def dfs(node,sparsem,sequences,t,k,g,i,gap_pos, gapDifferent):
+    def __init__(self, keys=None, parameters=None):
+        self.keys = None if keys is None else np.asarray(keys, dtype=np.int64)
+        self.parameters = None if parameters is None else dict(parameters)
+
+    def __len__(self):
+        return 0 if self.keys is None else len(self.keys)
+
+    def check(self, k, t, g, gapDifferent):
+        """Remember the parameters of the kmers the vocabulary is filled with,
+        or raise a ValueError if they differ from the remembered ones."""
+        parameters = {'k': int(k), 't': int(t), 'g': int(g), 'gapDifferent': bool(gapDifferent)}
+        if self.parameters is None:
+            self.parameters = parameters
+        elif self.parameters != parameters:
+            raise ValueError("The vocabulary was built with %s, not with %s." % (self.parameters, parameters))
+
+    def columns(self, keys):
+        """Return the columns of the canonical indices keys and a mask of the
+        keys that are part of the vocabulary. An empty vocabulary is filled
+        with the first keys that are not empty."""
+        if self.keys is None:
+            if len(keys) == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+            self.keys = np.unique(keys)
+        columns = np.searchsorted(self.keys, keys)
+        found = columns < len(self.keys)
+        found[found] = self.keys[columns[found]] == keys[found]
+        return columns, found
+
+    def save(self, fname):
+        """Save the vocabulary and its parameters to the file fname (in .npz
+        format)."""
+        parameters = self.parameters or {}
+        with open(fname, 'wb') as f:
+            np.savez(f, keys=np.zeros(0, dtype=np.int64) if self.keys is None else self.keys,
+                     empty=self.keys is None, **{name: value for name, value in parameters.items()})
+
+    @classmethod
+    def load(cls, fname):
+        """Load a vocabulary saved with save. A .npy file with only the keys
+        (saved by older versions) gives a vocabulary without parameters."""
+        data = np.load(fname)
+        if isinstance(data, np.ndarray):
+            return cls(data)
+        with data:
+            parameters = {name: data[name].item() for name in ('k', 't', 'g', 'gapDifferent') if name in data.files}
+            return cls(None if data['empty'] else data['keys'], parameters or None)
+
+def canonical_index(left,right,gaps,k,t,g):
+    """Return the position of the leaves (left and right half of the kmer and
+    the gap) in the full spectrum of kmers with up to g gaps."""
+    alphabet=len(alphabets[t])
+    if alphabet**k*(g+1) > np.iinfo(np.int64).max:
+        raise ValueError("The spectrum is too large for a vocabulary, use n_features instead.")
+    return (left*alphabet**(k-k//2)+right)*(g+1)+gaps
+
+def get_sparse(g,k,t,sequences,gap_pos,gapDifferent,n_features=None,n_jobs=1,vocabulary=None):
+    if vocabulary is not None and n_features is not None:
+        raise ValueError("A vocabulary can not be used together with n_features.")
+    letters,offsets=as_sequences(sequences)
+    starts,ends=offsets[:-1],offsets[1:]
+    n_sequences=len(ends)
+    # Initialization of all possible kmers: (seq number, start of kmer, last seen pos in kmer)
+    counts=np.maximum(ends-starts-k+1,0)
+    seqn=np.repeat(np.arange(n_sequences,dtype=np.int32),counts)
+    kpos=np.arange(len(seqn))-np.repeat(np.cumsum(counts)-counts-starts,counts)
+    root=(seqn,kpos,np.zeros(len(seqn),dtype=np.int32))
+    subtrees=[(root,0,0,0)]
+    if get_n_jobs(n_jobs)>1:
+        # Expand the first one or two levels, so that their subtrees can be
+        # traversed by different processes
+        for _ in range(min(1 if len(alphabets[t])>=get_n_jobs(n_jobs) else 2,k)):
+            subtrees=[child for subtree in subtrees for child in expand(*subtree,letters,ends,t,k,g,gap_pos)]
+    results=map_chunks(traverse_subtrees,subtrees,n_jobs,(letters,ends,t,k,g,gap_pos,gapDifferent))
+    # Number the leaves of all processes in the order of the traversal
+    offset=0
+    for result in results:
+        result[2]+=offset
+        offset=result[2].max() if len(result[2]) else offset
+    data,rows,leaves,gaps,left,right=[np.concatenate(x) for x in zip(*results)]
+    if n_features is not None:
+        columns,signs=hash_features(left,right,gaps,n_features)
+        return coo_matrix((signs*data,(rows,columns)),shape=(n_sequences,n_features))
+    if vocabulary is not None:
+        columns,found=vocabulary.columns(canonical_index(left,right,gaps,k,t,g))
+        return coo_matrix((data[found],(rows[found],columns[found])),shape=(n_sequences,len(vocabulary)))
+    # Columns are numbered in the order the leaves (and gaps) were visited
+    columns=np.unique(leaves*(g+1)+gaps,return_inverse=True)[1].ravel()
+    return coo_matrix((data,(rows,columns)),shape=(n_sequences,columns.max()+1 if len(columns) else 0))
+
+def traverse_subtrees(subtrees,letters,ends,t,k,g,gap_pos,gapDifferent):
+    """Traverse the given subtrees (occurrences, depth, number of the left half
+    of the kmer, number of the right half) one after another.
+    Returns the leaves found as flat arrays (data, i, leaf, gap, left half,
+    right half), with the leaves numbered from 1 in the order they were visited.
+    """
+    # sparsem = (data, i, leaf, gap, left half, right half)
+    sparsem=[[np.zeros(0,dtype=np.int64)] for _ in range(6)]
+    for subtree in subtrees:
+        dfs([subtree],sparsem,letters,ends,t,k,g,gap_pos,gapDifferent)
+    return [np.concatenate(x) for x in sparsem]
+
+def dfs(stack,sparsem,letters,ends,t,k,g,gap_pos,gapDifferent):
     """
     Depth-first-search Implementation
+    The nodes that still have to be visited, (occurrences, depth, number of
+    the left half of the kmer, number of the right half), are kept on a stack
+    instead of recursing. A node is dropped as soon as its children are on the
+    stack, so the memory is bounded by the depth times the number of
+    occurrences of the nodes on the stack.
     """
-    if i < k:
-        for letter in s[t]:
-            new_q=np.array([[0,0,0]])
-            # At the beginning, find positions of the current letter
-            if i == 0:
-                new_q=np.array([(seqn,kpos,last) for (seqn,kpos,last) in node._q if sequences[seqn][kpos] == letter])
+    while stack:
+        q,i,left,right=stack.pop()
+        seqn,kpos,last=q
+        # End reached, prepare data for conversion in sparse matrix
+        if i==k:
+            gaps=last-(k-1) if gapDifferent else np.zeros(len(last),dtype=np.int32)
+            add_leaf(sparsem,seqn,gaps,left,right,len(ends))
+            continue
+        # Visit the children in alphabetical order
+        stack.extend(reversed(expand(q,i,left,right,letters,ends,t,k,g,gap_pos)))
+        del q,seqn,kpos,last
+
+def expand(q,i,left,right,letters,ends,t,k,g,gap_pos):
+    """Create the children of a node at depth i < k. The occurrences of the
+    kmer of the node are kept as flat arrays and are split between the
+    children in one step by sorting them by their next letter.
+    Returns the children as (occurrences, depth, left half, right half).
+    """
+    alphabet=len(alphabets[t])
+    seqn,kpos,last=q
+    # At the beginning, find positions of the current letter
+    if i>0:
+        seqn,kpos,last=extend(q,ends,i,g,i in gap_pos)
+    next_letters=letters[kpos+last]
+    order=np.argsort(next_letters,kind='stable')
+    bounds=np.cumsum(np.bincount(next_letters,minlength=alphabet))
+    children=[]
+    for letter in s[t]:
+        occurrences=order[(bounds[letter-1] if letter>0 else 0):bounds[letter]]
+        # If there are still possibilities, go one step deeper
+        if len(occurrences)>0:
+            new_q=(seqn[occurrences],kpos[occurrences],last[occurrences])
+            if i<k//2:
+                children.append((new_q,i+1,left*alphabet+letter,right))
             else:
-                for (seqn,kpos,last) in node._q:
-                    # Only considers gaps in certain positions
-                    if i in gap_pos:
-                        up=update(sequences,(seqn,kpos,last),k,g,letter)
-                    else:
-                        up=update(sequences,(seqn,kpos,last),k,0,letter)
-                    if up.shape[0] > 0 :
-                        new_q=np.append(new_q,up,axis=0)
-                new_q = new_q[1:]
-            # If there are still possibilities, go one step deeper
-            if len(new_q)>0:
-                new_node = TrieNode(letter)
-                new_node._q=new_q
-                node._children.append(new_node)
-                dfs(new_node,sparsem,sequences,t,k,g,i+1,gap_pos,gapDifferent)
-    # End reached, prepare data for conversion in sparse matrix
-    elif i==k:
-        # sparsem =(data,i,j)
-        if len(sparsem[2]) == 0:
-            sparsem[2]=[-1]
-        if gapDifferent:
-            for gap in range(g+1):
-                used = set()
-                seqns=[seq for (seq,_,a) in node._q if (seq not in used)  and (a==gap+1)]
-                adding=np.zeros(len(seqns))
-                for qq in ((node._q)):
-                    if (qq[0] in seqns) & (qq[2]==gap+1):
-                        adding[seqns.index(qq[0])]+=1
-                sparsem[0]=np.append(sparsem[0],adding)
-                sparsem[1]=np.append(sparsem[1],np.array(seqns))
-                sparsem[2]=np.append(sparsem[2],np.array([sparsem[2][-1]+1 for s in seqns ]))
-        else:
-            used = set()
-            seqns=[seq for (seq,_,_) in node._q if seq not in used and (used.add(seq) or True)]
-            adding=np.zeros(len(seqns))
-            for qq in ((node._q)):
-                adding[seqns.index(qq[0])]+=1
-            sparsem[0]=np.append(sparsem[0],adding)
-            sparsem[1]=np.append(sparsem[1],np.array(seqns))
-            sparsem[2]=np.append(sparsem[2],np.array([sparsem[2][-1]+1 for s in seqns ]))
-
-# Checks if there are matches in the kmer
-def matching(sequences,seqn,kpos,last,k,g,letter):
-    return np.where(sequences[seqn][kpos+last:kpos+k+g] == letter)[0]
-
-def update(sequences,tupleq,k,g,letter):
-    new=matching(sequences,tupleq[0],tupleq[1],tupleq[2],k,g,letter)
-    return np.array([(tupleq[0],tupleq[1],tupleq[2]+x) for x in new if (tupleq[2]+x <= k+g) & (x>0)])
-
-def gapkernel(sequences,k,t,g=0,gap_pos=[], gapDifferent = False):
+                children.append((new_q,i+1,left,right*alphabet+letter))
+    return children
+
+def extend(q,ends,i,g,gap_allowed):
+    """Move every occurrence (seq number, start of kmer, last seen pos in kmer)
+    to the position of the letter i of the kmer. If a gap is allowed, the
+    letter may also be found after skipping positions, as long as the whole
+    kmer does not contain more than g gaps.
+    """
+    seqn,kpos,last=q
+    new_q=[]
+    for gap in range(g+1 if gap_allowed else 1):
+        new_last=last+1+gap
+        keep=(new_last-i<=g)&(kpos+new_last<ends[seqn])
+        new_q.append((seqn[keep],kpos[keep],new_last[keep]))
+    return [np.concatenate(x) for x in zip(*new_q)]
+
+def add_leaf(sparsem,seqn,gaps,left,right,n):
+    """Count the occurrences of a leaf kmer per sequence (and gap) and append
+    them to sparsem."""
+    keys,counts=np.unique(gaps.astype(np.int64)*n+seqn,return_counts=True)
+    sparsem[0].append(counts)
+    sparsem[1].append(keys%n)
+    sparsem[2].append(np.full(len(keys),len(sparsem[2])))
+    sparsem[3].append(keys//n)
+    sparsem[4].append(np.full(len(keys),left))
+    sparsem[5].append(np.full(len(keys),right))
+
+def gapkernel(sequences,k,t,g=0,gap_pos=[], gapDifferent = False, n_features=None, n_jobs=1, vocabulary=None):
     """Compute gapped kernel for given sequences, k-mer length k and gap length g,
     the specific type of data and the positions where gaps can occur gap_pos.
     Parameters:
     ----------
-    sequences:              A numpy array of sequences
+    sequences:              A list or numpy array of sequences, each an
+                            array of letter numbers, or Sequences
     k:                      Integer. The length of kmers to consider
     t:                      Integer. Specifies the alphabet. See sequenceTypes.
     g:                      Integer. Gaps allowed. 0 by default
     gap_pos:                Integer list. Positions, where gaps can occur.
                             If empty, all positions are considered
+    n_features:             Integer. If given, the k-mers are hashed into
+                            n_features columns with signed hashing.
+                            None by default.
+    n_jobs:                 Integer. Number of processes the subtrees of the
+                            first levels of the trie are distributed on.
+                            -1 uses all cpus. 1 by default.
+    vocabulary:             Vocabulary. If given, the columns are assigned by
+                            the vocabulary, so that matrices of different
+                            sequences have the same columns. None by default.
     Returns:
     -------
     A sparse matrix containing the k-spectrum with g-gaps for every sequence.
     """
     if not gap_pos:
         gap_pos=[i for i in range(k)]
-    return get_sparse(g,k,t,sequences,gap_pos,gapDifferent)
+    if vocabulary is not None:
+        vocabulary.check(k,t,g,gapDifferent)
+    return get_sparse(g,k,t,sequences,gap_pos,gapDifferent,n_features,n_jobs,vocabulary)
 
 def prepare_data(sequences, t, include_flanking = False):
-    """If sequences is not a numpy array, this function can converse them to one.
+    """Encode the sequences into arrays of letter numbers. A list is returned,
+    since the sequences can have different lengths.
     Parameters:
     ----------
     sequences:              A list of strings or Biopython sequences
@@ -129,13 +249,37 @@ def prepare_data(sequences, t, include_flanking = False):
                             by default.
     Returns:
     -------
-    A sparse matrix containing the k-spectrum with g-gaps for every sequence.
+    A list with a uint8 numpy array of letter numbers for every sequence.
+    """
+    letters,offsets=encode_sequences(sequences,t,include_flanking)
+    return [letters[start:end] for start,end in zip(offsets[:-1],offsets[1:])]
+
+def encode_sequences(sequences, t, include_flanking = False):
+    """Encode the sequences with a single table lookup, like prepare_data,
+    but keep them back to back in one array.
+    Parameters:
+    ----------
+    sequences:              A list of strings or Biopython sequences
+    t:                      Integer. Specifies the alphabet. See sequenceTypes.
+    include_flanking:       Boolean. If true, flanks are considered. False
+                            by default.
+    Returns:
+    -------
+    Sequences with the uint8 letter numbers of all sequences and their offsets.
     """
-    if include_flanking:
-        return np.array([np.array([alphabets[t].index(p.upper()) for p in x]) for x in sequences])
-    return np.array([np.array([alphabets[t].index(p) for p in x if ('A' <= p <= 'Z') & (p in alphabets[t])]) for x in sequences])
+    letters,offsets=encode_batch(sequences,t,include_flanking)
+    unknown=letters==UNKNOWN
+    if unknown.any():
+        if include_flanking:
+            x=sequences[np.searchsorted(offsets,np.argmax(unknown),side='right')-1]
+            raise ValueError("Sequence %s contains letters that are not part of the alphabet %s." % (x,alphabets[t]))
+        # number of letters kept before every offset
+        kept=np.zeros(len(letters)+1,dtype=np.int64)
+        np.cumsum(~unknown,out=kept[1:])
+        letters,offsets=letters[~unknown],kept[offsets]
+    return Sequences(letters,offsets)
 
-def gappypair_kernel(sequences,k,t,g=1,include_flanking=False,gapDifferent = True):
+def gappypair_kernel(sequences,k,t,g=1,include_flanking=False,gapDifferent = True,n_features=None,n_jobs=1,vocabulary=None,cache=None):
     """Compute gappypair kernel for given sequences, k-mer length k and
     gap length g, the specific type of data. If sequences are not a numpy array,
     prepare data will transform them to one.
@@ -148,10 +292,33 @@ def gappypair_kernel(sequences,k,t,g=1,include_flanking=False,gapDifferent = Tru
     g:                      Integer. Gaps allowed. 1 by default
     include_flanking:       Boolean. If true, flanks are considered. False
                             by default.
+    n_features:             Integer. If given, the k-mers are hashed into
+                            n_features columns with signed hashing.
+                            None by default.
+    n_jobs:                 Integer. Number of processes the subtrees of the
+                            first levels of the trie are distributed on.
+                            -1 uses all cpus. 1 by default.
+    vocabulary:             Vocabulary. If given, the columns are assigned by
+                            the vocabulary, so that matrices of different
+                            sequences have the same columns. None by default.
+    cache:                  A strkernel.lib.cache.Cache or the path of its
+                            directory. If given, the result is loaded from
+                            the cache when it was computed for the same
+                            sequences and parameters before. Not used with a
+                            vocabulary, which is filled while computing.
+                            None by default.
     Returns:
     -------
     A sparse matrix containing the gappypair with g-gaps for every sequence.
     """
-    if (isinstance(sequences[0], str)) | (isinstance(sequences[0], Seq)):
-        sequences=prepare_data(sequences, t, include_flanking)
-    return gapkernel(sequences,2*k,t,g,[k],gapDifferent)
+    def compute():
+        data=sequences
+        if (isinstance(data[0], str)) | (isinstance(data[0], Seq)):
+            data=encode_sequences(data, t, include_flanking)
+        return get_sparse(g,2*k,t,data,[k],gapDifferent,n_features,n_jobs,vocabulary)
+    if vocabulary is not None:
+        # the vocabulary remembers the k of the pairs, not of the whole kmer
+        vocabulary.check(k,t,g,gapDifferent)
+        return compute()
+    return cached(cache,compute,'gappy_trie.gappypair_kernel',sequences,k=k,t=t,g=g,include_flanking=include_flanking,
+                  gapDifferent=gapDifferent,n_features=n_features)
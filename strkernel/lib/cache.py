@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+'''
+Cache Module
+---
+Content-addressed cache of computed feature matrices and kernels on disk,
+shared by the kernels of the package. A result is stored under a hash of
+the input sequences and of the parameters it was computed with, so every
+configuration is only computed once per data set. The least recently used
+results are removed once the cache grows beyond its size limit.
+'''
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from strkernel.lib.encoding import Sequences, _to_bytes
+
+# changes whenever the stored format or the keys change
+CACHE_VERSION = 1
+
+
+class Cache:
+    """
+    Directory of cached results. Arrays and sparse matrices, or tuples of
+    them, are stored as one uncompressed .npz file per result; sparse
+    matrices keep their format.
+
+    Parameters:
+    ----------
+    directory:              Path of the directory the results are stored in.
+                            It is created if it does not exist.
+    max_bytes:              Integer. Size limit of all results together,
+                            the least recently used results are removed to
+                            stay below it. 2**30 (1 GiB) by default.
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, name, sequences, **parameters):
+        """Return the hash of the sequences and the parameters of the result
+        of the function name, as a hex string."""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(json.dumps([CACHE_VERSION, name, parameters], sort_keys=True, default=str).encode())
+        if isinstance(sequences, Sequences):
+            for values in sequences:
+                _update_array(h, np.asarray(values))
+        elif isinstance(sequences, np.ndarray) and sequences.dtype != object:
+            _update_array(h, sequences)
+        else:
+            for sequence in sequences:
+                data = _sequence_bytes(sequence)
+                h.update(len(data).to_bytes(8, 'little'))
+                h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """Return the result stored under key, or None if there is none."""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                values = [_load_value(f, str(i)) for i in range(int(f['n']))]
+                result = tuple(values) if bool(f['tuple']) else values[0]
+        except FileNotFoundError:
+            return None
+        # mark the result as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def save(self, key, result):
+        """Store an array, sparse matrix or tuple of them under key and remove
+        the least recently used results if the cache is too large."""
+        values = result if isinstance(result, tuple) else (result,)
+        arrays = {'n': np.array(len(values)), 'tuple': np.array(isinstance(result, tuple))}
+        for i, value in enumerate(values):
+            arrays.update(_dump_value(value, str(i)))
+        # write to a temporary file first, so readers never see partial results
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used results until all results together
+        are smaller than max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def clear(self):
+        """Remove all results."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.directory, name))
+
+
+def get_cache(cache):
+    """Return the Cache for the cache argument of a kernel function: a Cache,
+    the path of its directory or None (no caching)."""
+    if cache is None or isinstance(cache, Cache):
+        return cache
+    return Cache(cache)
+
+def cached(cache, compute, name, sequences, **parameters):
+    """Return the result of compute(), loaded from the cache if it was
+    computed for the same sequences and parameters before, and stored in the
+    cache otherwise. Without a cache, compute() is simply called.
+    """
+    cache = get_cache(cache)
+    if cache is None:
+        return compute()
+    key = cache.key(name, sequences, **parameters)
+    result = cache.load(key)
+    if result is None:
+        result = compute()
+        cache.save(key, result)
+    return result
+
+def _update_array(h, values):
+    h.update(values.dtype.str.encode())
+    h.update(np.array(values.shape, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(values).tobytes())
+
+def _sequence_bytes(sequence):
+    """Return the bytes a single sequence is hashed with."""
+    if isinstance(sequence, np.ndarray):
+        return sequence.dtype.str.encode() + sequence.tobytes()
+    if isinstance(sequence, (list, tuple)) and len(sequence) and not isinstance(sequence[0], str):
+        # integer encoded sequence
+        return b'<i8' + np.asarray(sequence, dtype=np.int64).tobytes()
+    return _to_bytes(sequence)
+
+def _dump_value(value, prefix):
+    if issparse(value):
+        matrix = value.tocsr()
+        return {prefix + '_format': np.array(value.format), prefix + '_shape': np.array(matrix.shape),
+                prefix + '_data': matrix.data, prefix + '_indices': matrix.indices,
+                prefix + '_indptr': matrix.indptr}
+    return {prefix: np.asarray(value)}
+
+def _load_value(f, prefix):
+    if prefix in f.files:
+        return f[prefix]
+    matrix = csr_matrix((f[prefix + '_data'], f[prefix + '_indices'], f[prefix + '_indptr']),
+                        shape=tuple(f[prefix + '_shape']))
+    return matrix.asformat(str(f[prefix + '_format']))
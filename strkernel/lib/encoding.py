@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+Encoding Module
+---
+Table driven encoding of sequences into arrays of alphabet codes, shared by
+the kernels of the package. Every alphabet has a fixed code per letter, so
+that all sequences are encoded the same way.
+'''
+from collections import namedtuple
+from functools import lru_cache
+from itertools import chain
+
+import numpy as np
+
+sequenceTypes={'dna':0,'rna':1,'aa':2,'aa+s':3}
+# DNA/RNA, Amino acids (all 20), Amino acids selenocystein
+alphabets=['ACGT','ACGU','ACDEFGHIKLMNPQRSTVWY','ACDEFGHIKLMNPQRSTUVWY']
+
+# code of characters which are not part of the alphabet
+UNKNOWN = 255
+# code of flanking characters which are removed
+SKIP = 254
+
+# sequences stored back to back in one array, sequence i is
+# letters[offsets[i]:offsets[i + 1]]
+Sequences = namedtuple('Sequences', ['letters', 'offsets'])
+
+
+@lru_cache(maxsize=None)
+def encoding_table(t=0, include_flanking=True):
+    """Return the 256-entry table with the code of every byte. The table is
+    built once per alphabet and is read-only.
+    Parameters:
+    ----------
+    t:                      Integer. Specifies the alphabet. See sequenceTypes.
+    include_flanking:       Boolean. If true, lower case letters (flanks) get
+                            the code of their upper case letter, otherwise
+                            everything except upper case letters is
+                            removed. True by default.
+    Returns:
+    -------
+    A uint8 numpy array. Characters which are not part of the alphabet get
+    the code UNKNOWN, removed characters the code SKIP.
+    """
+    table=np.full(256,UNKNOWN,dtype=np.uint8)
+    if not include_flanking:
+        table[:ord('A')]=SKIP
+        table[ord('Z')+1:]=SKIP
+    for i,x in enumerate(alphabets[t]):
+        table[ord(x)]=i
+        if include_flanking:
+            table[ord(x.lower())]=i
+    table.flags.writeable=False
+    return table
+
+def _to_bytes(sequence):
+    """Return the characters of a string, Biopython sequence or list of
+    characters as bytes. Non-ascii characters are replaced by '?'."""
+    if isinstance(sequence,(bytes,bytearray)):
+        return bytes(sequence)
+    if not isinstance(sequence,str):
+        sequence="".join(str(x) for x in sequence) if isinstance(sequence,(list,tuple)) else str(sequence)
+    return sequence.encode('ascii','replace')
+
+def encode(sequence, t=0, include_flanking=True):
+    """Encode a single sequence into a uint8 array of alphabet codes.
+    Parameters:
+    ----------
+    sequence:               A string, Biopython sequence, bytes or list of
+                            characters
+    t:                      Integer. Specifies the alphabet. See sequenceTypes.
+    include_flanking:       Boolean. If false, everything except upper case
+                            letters is removed. True by default.
+    Returns:
+    -------
+    A uint8 numpy array with the code of every letter, UNKNOWN for characters
+    which are not part of the alphabet.
+    """
+    codes=encoding_table(t,include_flanking)[np.frombuffer(_to_bytes(sequence),dtype=np.uint8)]
+    if not include_flanking:
+        codes=codes[codes!=SKIP]
+    return codes
+
+def encode_batch(sequences, t=0, include_flanking=True):
+    """Encode a batch of sequences with a single table lookup.
+    Parameters:
+    ----------
+    sequences:              An iterable of strings, Biopython sequences,
+                            bytes or lists of characters
+    t:                      Integer. Specifies the alphabet. See sequenceTypes.
+    include_flanking:       Boolean. If false, everything except upper case
+                            letters is removed. True by default.
+    Returns:
+    -------
+    Sequences with the uint8 codes of all sequences and their offsets.
+    """
+    data=[_to_bytes(x) for x in sequences]
+    offsets=np.zeros(len(data)+1,dtype=np.int64)
+    np.cumsum([len(x) for x in data],out=offsets[1:])
+    codes=encoding_table(t,include_flanking)[np.frombuffer(b"".join(data),dtype=np.uint8)]
+    if not include_flanking:
+        keep=codes!=SKIP
+        # number of letters kept before every offset
+        kept=np.zeros(len(codes)+1,dtype=np.int64)
+        np.cumsum(keep,out=kept[1:])
+        codes,offsets=codes[keep],kept[offsets]
+    return Sequences(codes,offsets)
+
+def as_sequences(sequences):
+    """Convert encoded sequences into Sequences. The sequences may have
+    different lengths; a single sequence is treated as one sample.
+    Parameters:
+    ----------
+    sequences:              A list of arrays of letter numbers, a 2D array
+                            or Sequences
+    Returns:
+    -------
+    Sequences with the letters as uint8 if they fit, int64 otherwise.
+    """
+    if isinstance(sequences,Sequences):
+        return sequences
+    if isinstance(sequences,np.ndarray) and sequences.dtype!=object:
+        # rectangular data, or a single sequence
+        if sequences.ndim==1:
+            sequences=sequences[np.newaxis]
+        assert sequences.ndim==2
+        letters=sequences.ravel()
+        offsets=np.arange(sequences.shape[0]+1,dtype=np.int64)*sequences.shape[1]
+    else:
+        sequences=list(sequences)
+        if sequences and np.ndim(sequences[0])==0:
+            sequences=[sequences]
+        offsets=np.zeros(len(sequences)+1,dtype=np.int64)
+        np.cumsum([len(x) for x in sequences],out=offsets[1:])
+        letters=np.fromiter(chain.from_iterable(sequences),dtype=np.int64,count=offsets[-1])
+    if len(letters)==0 or (letters.min()>=0 and letters.max()<256):
+        letters=letters.astype(np.uint8)
+    return Sequences(letters,offsets)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+'''
+FASTA Module
+---
+Streaming reader for FASTA and plain text files (one sequence per line).
+The file is read in large binary blocks and the records are parsed with
+numpy, so that neither Biopython nor a Python loop over the lines is needed.
+The sequences are yielded in batches, already encoded for the kernels.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from strkernel.lib.encoding import Sequences, encoding_table
+
+# names: the headers of the records (without '>'), None for plain text
+# sequences: Sequences with the codes of the letters of all records
+# flanks: boolean array, True for the letters that are lower case (flanks)
+FastaBatch = namedtuple('FastaBatch', ['names', 'sequences', 'flanks'])
+
+# bytes which are part of sequences, whitespace is ignored
+IS_LETTER = np.ones(256, dtype=bool)
+IS_LETTER[[ord(c) for c in ' \t\r\n\v\f']] = False
+
+
+def read_batches(source, batch_size=10000, t=0, block_size=2**24):
+    """Read a FASTA or plain text file and yield batches of encoded sequences.
+    Sequences of FASTA records may span several lines. Files whose first
+    character is not '>' are read as plain text with one sequence per line;
+    empty lines are skipped.
+    Parameters:
+    ----------
+    source:                 A path or a file object opened in binary mode.
+    batch_size:             Integer. Number of sequences per batch, the last
+                            batch may be smaller. 10000 by default.
+    t:                      Integer. Specifies the alphabet the letters are
+                            encoded with (see sequenceTypes); lower case
+                            letters get the code of their upper case letter.
+                            If None, the letters are kept as ASCII bytes.
+                            0 (DNA) by default.
+    block_size:             Integer. Number of bytes that are read at once.
+                            2**24 by default.
+    Returns:
+    -------
+    A generator of FastaBatch.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1.")
+    table=None if t is None else encoding_table(t,include_flanking=True)
+    names,letters,lengths=[],[],[]
+    for block in _read_records(source,block_size):
+        names.extend(block[0])
+        letters.append(block[1])
+        lengths.append(block[2])
+        if len(names)<batch_size:
+            continue
+        # split the records read so far into batches
+        letters,lengths=np.concatenate(letters),np.concatenate(lengths)
+        offsets=_offsets(lengths)
+        for start in range(0,len(names)-batch_size+1,batch_size):
+            yield _batch(names[start:start+batch_size],letters[offsets[start]:offsets[start+batch_size]],lengths[start:start+batch_size],table)
+        start+=batch_size
+        names,letters,lengths=names[start:],[letters[offsets[start]:]],[lengths[start:]]
+    if names:
+        yield _batch(names,np.concatenate(letters),np.concatenate(lengths),table)
+
+def iter_sequences(source, batch_size=10000, block_size=2**24):
+    """Read a FASTA or plain text file and yield batches of sequences as
+    strings, for the functions which take a list of sequences.
+    Parameters:
+    ----------
+    source:                 A path or a file object opened in binary mode.
+    batch_size:             Integer. Number of sequences per batch, the last
+                            batch may be smaller. 10000 by default.
+    block_size:             Integer. Number of bytes that are read at once.
+                            2**24 by default.
+    Returns:
+    -------
+    A generator of lists of strings, the lower case flanks are kept.
+    """
+    for batch in read_batches(source,batch_size=batch_size,t=None,block_size=block_size):
+        letters,offsets=batch.sequences
+        data=letters.tobytes().decode('ascii','replace')
+        yield [data[start:stop] for start,stop in zip(offsets[:-1].tolist(),offsets[1:].tolist())]
+
+def read_sequences(source, block_size=2**24):
+    """Read all sequences of a FASTA or plain text file as strings, for the
+    functions which take a list of sequences.
+    Parameters:
+    ----------
+    source:                 A path or a file object opened in binary mode.
+    block_size:             Integer. Number of bytes that are read at once.
+                            2**24 by default.
+    Returns:
+    -------
+    A list of strings, the lower case flanks are kept.
+    """
+    sequences=[]
+    for batch in iter_sequences(source,batch_size=2**20,block_size=block_size):
+        sequences.extend(batch)
+    return sequences
+
+def _offsets(lengths):
+    offsets=np.zeros(len(lengths)+1,dtype=np.int64)
+    np.cumsum(lengths,out=offsets[1:])
+    return offsets
+
+def _batch(names, letters, lengths, table):
+    """Encode the letters of a batch and mark the flanks."""
+    flanks=(letters>=ord('a'))&(letters<=ord('z'))
+    codes=letters if table is None else table[letters]
+    if names and names[0] is None:
+        names=None
+    return FastaBatch(names,Sequences(codes,_offsets(lengths)),flanks)
+
+def _read_records(source, block_size):
+    """Read the file block by block and yield the (names, letters, lengths) of
+    the complete records in each block."""
+    if isinstance(source,(str,bytes)) or hasattr(source,'__fspath__'):
+        with open(source,'rb') as f:
+            yield from _read_records(f,block_size)
+        return
+    fasta=None
+    rest=b""
+    while True:
+        block=source.read(block_size)
+        data=rest+block
+        if fasta is None:
+            stripped=data.lstrip()
+            if not stripped and block:
+                rest=data
+                continue
+            fasta=stripped[:1]==b">"
+        if not block:
+            if data:
+                yield _parse(data,fasta)
+            return
+        # cut the data after the last complete record
+        end=data.rfind(b"\n>") if fasta else data.rfind(b"\n")
+        if end<0:
+            rest=data
+            continue
+        yield _parse(data[:end+1],fasta)
+        rest=data[end+1:]
+
+def _parse(raw, fasta):
+    """Parse complete records. Returns the names, the letters of all records
+    as one uint8 array and the length of every record."""
+    data=np.frombuffer(raw,dtype=np.uint8)
+    newlines=np.flatnonzero(data==ord('\n'))
+    starts=np.concatenate([[0],newlines+1])
+    if starts[-1]==len(data):
+        starts=starts[:-1]
+    letter=IS_LETTER[data]
+    if fasta:
+        # a record starts at every header line and ends at the next one
+        headers=starts[data[starts]==ord('>')]
+        header_ends=np.concatenate([newlines,[len(data)]])[np.searchsorted(newlines,headers)]
+        in_header=np.zeros(len(data)+1,dtype=np.int8)
+        in_header[headers]=1
+        in_header[header_ends]=-1
+        letter&=np.cumsum(in_header[:-1],dtype=np.int8)==0
+        # lines before the first header are ignored
+        letter[:headers[0] if len(headers) else len(data)]=False
+        text=raw.decode('ascii','replace')
+        names=[text[start+1:end].strip() for start,end in zip(headers.tolist(),header_ends.tolist())]
+        boundaries=headers
+    else:
+        boundaries=starts
+    positions=np.flatnonzero(letter)
+    lengths=np.diff(np.searchsorted(positions,np.concatenate([boundaries,[len(data)]])))
+    if not fasta:
+        # every line with letters is a record
+        lengths=lengths[lengths>0]
+        names=[None]*len(lengths)
+    return names,data[positions],lengths
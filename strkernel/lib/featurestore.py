@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+'''
+Feature Store Module
+---
+On-disk storage of sparse feature matrices which are computed batch by
+batch. The rows are appended as blocks of a CSR matrix to three flat binary
+files (data, indices and indptr), which are memory-mapped for reading, so
+neither the sequences nor the matrix have to fit into memory. Running
+statistics of the rows appended so far are kept alongside; they are sparse
+as well, since the spectra of large k or alphabets have far more columns
+than ever occur.
+'''
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+class FeatureStore:
+    """
+    Sparse matrix on disk, built by appending row blocks. A directory that
+    already contains a store is opened and further rows are appended to it.
+    The size of the store is only updated after the rows of a block are
+    written, so the files are cut back to it when the store is opened after
+    an interrupted append.
+
+    Parameters:
+    ----------
+    directory:              Path of the directory the files are stored in.
+                            It is created if it does not exist.
+    n_features:             Integer. Number of columns. If None, it is taken
+                            from the first block. None by default.
+    dtype:                  The type of the values. float64 by default.
+    """
+    def __init__(self, directory, n_features=None, dtype=np.float64):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json')) as f:
+                meta = json.load(f)
+            if n_features is not None and n_features != meta['n_features']:
+                raise ValueError("The store has %d features, not %d." % (meta['n_features'], n_features))
+            self.n_features = meta['n_features']
+            self.dtype = np.dtype(meta['dtype'])
+            self.n_rows = meta['n_rows']
+            self.nnz = meta['nnz']
+            self._truncate()
+            with np.load(self._path('document_frequency.npz')) as f:
+                self._df_columns, self._df_counts = f['columns'], f['counts']
+                complete = int(f['n_rows']) == self.n_rows
+            if not complete:
+                # the append was interrupted after the statistics were written
+                self._df_columns = np.zeros(0, dtype=np.int64)
+                self._df_counts = np.zeros(0, dtype=np.int64)
+                for block in self.iter_blocks():
+                    self._add_document_frequency(block.indices)
+        else:
+            self.n_features = n_features
+            self.dtype = np.dtype(dtype)
+            self.n_rows = 0
+            self.nnz = 0
+            self._df_columns = np.zeros(0, dtype=np.int64)
+            self._df_counts = np.zeros(0, dtype=np.int64)
+            for name in ('data', 'indices', 'norms'):
+                open(self._path(name + '.bin'), 'wb').close()
+            with open(self._path('indptr.bin'), 'wb') as f:
+                f.write(np.zeros(1, dtype=np.int64).tobytes())
+            if n_features is not None:
+                self.flush()
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def shape(self):
+        return (self.n_rows, self.n_features or 0)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _truncate(self):
+        """Cut the binary files back to the size of the store, removing the
+        rows of an interrupted append."""
+        sizes = {'data': self.nnz * self.dtype.itemsize, 'indices': self.nnz * 8,
+                 'indptr': (self.n_rows + 1) * 8, 'norms': self.n_rows * 8}
+        for name, size in sizes.items():
+            path = self._path(name + '.bin')
+            if os.path.getsize(path) < size:
+                raise ValueError("%s is shorter than the %d rows of the store." % (path, self.n_rows))
+            if os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def _replace(self, name, data):
+        """Write data to a temporary file first and replace the file name
+        with it, so that it is never partially written."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def _read(self, name, dtype, count):
+        """Memory-map the first count values of a binary file."""
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._path(name + '.bin'), dtype=dtype, mode='r', shape=(count,))
+
+    def append(self, block):
+        """Append the rows of a sparse or dense matrix and update the
+        statistics. Returns the store, so that calls can be chained.
+        """
+        block = (block if issparse(block) else csr_matrix(block)).tocsr()
+        if self.n_features is None:
+            self.n_features = block.shape[1]
+        if block.shape[1] != self.n_features:
+            raise ValueError("The block has %d features, the store %d." % (block.shape[1], self.n_features))
+        block = block.astype(self.dtype)
+        block.sum_duplicates()
+        block.eliminate_zeros()
+
+        indptr = self.nnz + block.indptr[1:].astype(np.int64)
+        norms = np.sqrt(np.asarray(block.multiply(block).sum(axis=1), dtype=np.float64).ravel())
+        for name, values in (('data', block.data), ('indices', block.indices.astype(np.int64)),
+                             ('indptr', indptr), ('norms', norms)):
+            with open(self._path(name + '.bin'), 'ab') as f:
+                f.write(np.ascontiguousarray(values).tobytes())
+        self._add_document_frequency(block.indices)
+        self.n_rows += block.shape[0]
+        self.nnz += block.nnz
+        self.flush()
+        return self
+
+    def _add_document_frequency(self, indices):
+        """Add the columns of a block, which are unique per row, to the
+        sorted columns and counts of the document frequency."""
+        columns, counts = np.unique(indices.astype(np.int64), return_counts=True)
+        merged = np.union1d(self._df_columns, columns)
+        merged_counts = np.zeros(len(merged), dtype=np.int64)
+        merged_counts[np.searchsorted(merged, self._df_columns)] += self._df_counts
+        merged_counts[np.searchsorted(merged, columns)] += counts
+        self._df_columns, self._df_counts = merged, merged_counts
+
+    def extend(self, blocks):
+        """Append every block of an iterable, for example a generator which
+        computes the features of one batch of sequences at a time.
+        """
+        for block in blocks:
+            self.append(block)
+        return self
+
+    def flush(self):
+        """Write the statistics and the size of the store to disk. The size
+        is written last, it marks the rows as complete."""
+        statistics = io.BytesIO()
+        np.savez(statistics, columns=self._df_columns, counts=self._df_counts, n_rows=self.n_rows)
+        self._replace('document_frequency.npz', statistics.getvalue())
+        self._replace('meta.json', json.dumps({'n_features': int(self.n_features), 'dtype': self.dtype.str,
+                                               'n_rows': int(self.n_rows), 'nnz': int(self.nnz)}).encode())
+
+    @property
+    def document_frequency(self):
+        """The number of rows every column occurs in, as a sparse matrix of
+        shape (1, n_features). Only the columns that occur are stored."""
+        return csr_matrix((self._df_counts, self._df_columns, [0, len(self._df_columns)]),
+                          shape=(1, self.n_features or 0))
+
+    @property
+    def norms(self):
+        """The euclidean norm of every row, memory-mapped."""
+        return self._read('norms', np.float64, self.n_rows)
+
+    def rows(self, start, stop):
+        """Return the rows start to stop as an in-memory csr matrix."""
+        start, stop, _ = slice(start, stop).indices(self.n_rows)
+        stop = max(start, stop)
+        indptr = np.array(self._read('indptr', np.int64, self.n_rows + 1)[start:stop + 1])
+        begin, end = indptr[0], indptr[-1]
+        data = np.array(self._read('data', self.dtype, self.nnz)[begin:end])
+        indices = np.array(self._read('indices', np.int64, self.nnz)[begin:end])
+        return csr_matrix((data, indices, indptr - begin), shape=(stop - start, self.n_features or 0))
+
+    def iter_blocks(self, block_size=10000):
+        """Yield the matrix as csr matrices of block_size rows, for models
+        which are fitted batch by batch (partial_fit).
+        """
+        for start in range(0, self.n_rows, block_size):
+            yield self.rows(start, start + block_size)
+
+    def to_csr(self):
+        """Load the whole matrix into memory as a csr matrix."""
+        return self.rows(0, self.n_rows)
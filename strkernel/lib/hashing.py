@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+'''
+Hashing Module
+---
+Signed feature hashing of (k-mer, gap) keys into a fixed number of buckets.
+'''
+import numpy as np
+
+
+def hash_features(left, right, gap, n_features):
+    """Map the keys (left, right, gap) to a bucket in range(n_features) and a
+    sign of +1 or -1. left and right are the integer codes of the two halves
+    of a k-mer, gap is the gap id. Only 64 bit integer arithmetic is used,
+    so the key space is not limited by the size of the explicit spectrum.
+    The sign makes collisions cancel out in expectation, which keeps inner
+    products of hashed vectors unbiased.
+
+    Returns:
+    -------
+    Two numpy arrays with the buckets and the signs of the keys.
+    """
+    with np.errstate(over='ignore'):
+        h = np.asarray(left, dtype=np.int64).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        h ^= np.asarray(right, dtype=np.int64).astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+        h ^= np.asarray(gap, dtype=np.int64).astype(np.uint64) * np.uint64(0x165667B19E3779F9)
+        # splitmix64 finalizer
+        h ^= h >> np.uint64(30)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(27)
+        h *= np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+    buckets = (h % np.uint64(n_features)).astype(np.int64)
+    signs = 1 - 2 * (h >> np.uint64(63)).astype(np.int64)
+    return buckets, signs
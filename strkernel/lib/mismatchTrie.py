@@ -6,7 +6,13 @@
  <https://github.com/dohmatob/kernels/blob/master/python/trie.py>
 """
 
+import concurrent.futures
+
 import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+from strkernel.lib.encoding import Sequences, as_sequences
+from strkernel.lib.parallel import get_n_jobs, map_chunks, split_chunks
 
 
 class MismatchTrie(object):
@@ -193,9 +199,12 @@ class MismatchTrie(object):
         full_label: mismatch kmers generated by traversing labels from root to leaf
         """
 
-        for i in self.kmers:
-            for j in self.kmers:
-                kernel[i, j] += len(self.kmers[i]) * len(self.kmers[j])
+        indices = np.fromiter(self.kmers.keys(), dtype=int, count=len(self.kmers))
+        counts = np.fromiter((len(kmers) for kmers in self.kmers.values()),
+                             dtype=int, count=len(self.kmers))
+
+        # rank-1 update with the k-mer counts of this leaf
+        kernel[np.ix_(indices, indices)] += np.outer(counts, counts)
 
 
     def traverse(self, training_data, l, k, m, kernel=None,
@@ -270,6 +279,82 @@ class MismatchTrie(object):
         return kernel, n_surviving_kmers, go_ahead
 
 
+    def traverse_frontier(self, training_data, l, k, m, kernel=None,
+                          kernel_update_callback=None, n_jobs=1):
+        """
+        Iterative alternative to `traverse` which gives the same kernel.
+        No trie nodes are created; the live k-mers of a node are kept as
+        flat arrays (sample, position, mismatches) on a stack.
+
+        Parameters
+        ----------
+        training_data: list of n_samples integer sequences of any length,
+                       2D array or `Sequences`, training data for the kernel
+        l: int, size of alphabet
+        k: int, we will use k-mers to compute the kernel
+        m: int
+           maximum number of mismatches for 2 k-mers to be considered 'similar'
+        kernel: 2D array of shape (n_samples, n_samples)
+                optional (default None) kernel to be, or being, estimated
+        n_jobs: int, optional (default 1)
+                number of processes the subtrees below the first levels of
+                the trie are distributed on, -1 uses all cpus
+
+        Returns
+        -------
+        kernel: 2D array of shape (n_samples, n_samples), estimated kernel
+        n_survived_kmers: int, number of leaf nodes that survived the traversal
+        leafs: list of (labels, samples, counts) of the surviving leafs
+        """
+
+        # the sequences are only converted once for the whole traversal
+        training_data = as_sequences(training_data)
+
+        # initialize kernel if None
+        if kernel is None:
+            n_samples = len(training_data.offsets) - 1
+            kernel = np.zeros((n_samples, n_samples))
+
+        if get_n_jobs(n_jobs) > 1:
+            # shared memory needs Python 3.8, it is only imported when used
+            from multiprocessing import resource_tracker, shared_memory
+            n_jobs = get_n_jobs(n_jobs)
+            nodes = split_nodes(training_data, l, k, m, n_jobs)
+            # the workers have to share the resource tracker of this process,
+            # otherwise their partial kernels are unlinked when they exit
+            resource_tracker.ensure_running()
+            chunks = [nodes[start:stop] for start, stop in split_chunks(len(nodes), n_jobs)]
+            results = [None] * len(chunks)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(subtree_kernel, chunk, training_data, l, k, m,
+                                           kernel.dtype) for chunk in chunks]
+                try:
+                    # add the partial kernels as soon as the workers finish
+                    for future in concurrent.futures.as_completed(futures):
+                        name, subtree_leafs = future.result()
+                        memory = shared_memory.SharedMemory(name=name)
+                        try:
+                            kernel += np.ndarray(kernel.shape, dtype=kernel.dtype,
+                                                 buffer=memory.buf)
+                        finally:
+                            memory.close()
+                        results[futures.index(future)] = subtree_leafs
+                finally:
+                    # release the partial kernels of all workers, also those
+                    # that finish after another worker or the addition failed
+                    for future in futures:
+                        future.cancel()
+                    concurrent.futures.wait(futures)
+                    for future in futures:
+                        if not future.cancelled() and future.exception() is None:
+                            unlink_shared_memory(future.result()[0])
+            leafs = [leaf for subtree_leafs in results for leaf in subtree_leafs]
+            return kernel, len(leafs), leafs
+
+        leafs = add_leaf_batches(kernel, iter_leafs(training_data, l, k, m))
+
+        return kernel, len(leafs), leafs
+
     def __iter__(self):
         """
         Return an iterator on the nodes of the trie
@@ -284,3 +369,370 @@ class MismatchTrie(object):
         for leaf in self:
             if leaf.is_leaf():
                 yield leaf
+
+
+# number of (leaf, sample) counts that are added to the kernel at once
+LEAF_BATCH_SIZE = 2 ** 20
+
+# number of kernel entries a block of the product C^T C may hold at most
+KERNEL_BLOCK_SIZE = 2 ** 18
+
+
+def add_leafs(kernel, leafs):
+    """
+    Add the contributions of a batch of leafs to the kernel. The k-mer counts
+    of the leafs form a sparse (leaf, sample) matrix C, so the update is the
+    sparse product kernel += C^T C. The product is computed for blocks of
+    rows of the kernel, so that it never holds more than `KERNEL_BLOCK_SIZE`
+    entries at once, however many pairs of samples share the leafs.
+
+    Parameters
+    ----------
+    kernel: 2D array of shape (n_samples, n_samples)
+            kernel to be updated
+    leafs: list of (labels, samples, counts) as yielded by `iter_leafs`
+    """
+
+    if not leafs:
+        return
+
+    rows = np.repeat(np.arange(len(leafs)), [len(samples) for _, samples, _ in leafs])
+    columns = np.concatenate([samples for _, samples, _ in leafs])
+    data = np.concatenate([counts for _, _, counts in leafs]).astype(float)
+    counts = csc_matrix((data, (rows, columns)), shape=(len(leafs), kernel.shape[1]))
+    del rows, columns, data
+
+    n_samples = kernel.shape[1]
+    block_size = max(KERNEL_BLOCK_SIZE // max(n_samples, 1), 1)
+    for start in range(0, n_samples, block_size):
+        block = counts[:, start:start + block_size]
+        if not block.nnz:
+            continue
+        product = (block.T @ counts).tocoo()
+        kernel[start + product.row, product.col] += product.data
+        del product
+
+
+def add_leaf_batches(kernel, leafs):
+    """
+    Add the leafs to the kernel in batches of about `LEAF_BATCH_SIZE`
+    (leaf, sample) counts, so that the counts of all leafs are never
+    turned into one sparse matrix at once.
+
+    Parameters
+    ----------
+    kernel: 2D array of shape (n_samples, n_samples)
+            kernel to be updated
+    leafs: iterable of (labels, samples, counts) as yielded by `iter_leafs`
+
+    Returns
+    -------
+    leafs: list of the leafs that were added
+    """
+
+    added = []
+    batch_start, batch_size = 0, 0
+    for leaf in leafs:
+        added.append(leaf)
+        batch_size += len(leaf[1])
+        # update the kernel with a batch of leafs
+        if batch_size >= LEAF_BATCH_SIZE:
+            add_leafs(kernel, added[batch_start:])
+            batch_start, batch_size = len(added), 0
+    add_leafs(kernel, added[batch_start:])
+
+    return added
+
+
+def root_node(training_data, k):
+    """
+    Return the root of the trie as (labels, samples, positions, mismatches),
+    with all the k-mers of the training data and no mismatches. positions
+    are the starts of the k-mers in training_data.letters.
+    """
+
+    offsets = training_data.offsets
+    n_kmers = np.maximum(np.diff(offsets) - k + 1, 0)
+
+    # the len(training_data[index]) - k + 1 kmers of each input training string
+    samples = np.repeat(np.arange(len(n_kmers)), n_kmers)
+    positions = np.arange(n_kmers.sum(), dtype=np.int64) + np.repeat(
+        offsets[:-1] - (np.cumsum(n_kmers) - n_kmers), n_kmers)
+    mismatches = np.zeros(len(samples), dtype=np.int64)
+
+    return (), samples, positions, mismatches
+
+
+def expand_node(training_data, node, l, m):
+    """
+    Return the children of a node of the trie that still have k-mers with at
+    most m mismatches, in the order of their labels. The k-mers of the l
+    children are computed from one comparison of the next characters, by
+    masking out the k-mers with too many mismatches.
+    """
+
+    labels, samples, positions, mismatches = node
+    chars = training_data.letters[positions + len(labels)]
+    children = []
+    for label in range(l):
+        # update mismatch counts and keep the k-mers with at most m mismatches
+        child_mismatches = mismatches + (chars != label)
+        keep = child_mismatches <= m
+        if keep.any():
+            children.append((labels + (label,), samples[keep],
+                             positions[keep], child_mismatches[keep]))
+
+    return children
+
+
+def iter_leafs(training_data, l, k, m, nodes=None):
+    """
+    Traverse the mismatch trie depth first without building it.
+    For every node, the k-mers that are still within m mismatches of the
+    node's label are kept as three flat arrays (sample, position, mismatches).
+
+    Parameters
+    ----------
+    training_data: list of n_samples integer sequences of any length,
+                   2D array or `Sequences`, training data for the kernel
+    l: int, size of alphabet
+    k: int, we will use k-mers to compute the kernel
+    m: int
+       maximum number of mismatches for 2 k-mers to be considered 'similar'
+    nodes: list of nodes, optional (default None)
+           the subtrees to traverse, as returned by `split_nodes`. By
+           default the whole trie is traversed.
+
+    Yields
+    -------
+    labels, samples, counts: the labels from the root to a surviving leaf,
+    the samples that have k-mers at this leaf and the number of these k-mers
+    per sample. Leafs are yielded in the order of their labels.
+    """
+
+    training_data = as_sequences(training_data)
+    if nodes is None:
+        nodes = [root_node(training_data, k)]
+
+    # (labels, samples, positions, mismatches) of the nodes left to visit
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        labels, samples = node[:2]
+        if len(labels) == k:
+            # we've hit a leaf
+            samples, counts = np.unique(samples, return_counts=True)
+            yield labels, samples, counts
+            continue
+
+        # visit the children in the order of their labels
+        stack.extend(reversed(expand_node(training_data, node, l, m)))
+
+
+def split_nodes(training_data, l, k, m, n_jobs):
+    """
+    Expand the trie level by level until there are a few subtrees per job,
+    or the leafs are reached. The subtrees are independent of each other
+    and can be traversed by different processes.
+
+    Returns
+    -------
+    nodes: list of the nodes, in the order of their labels
+    """
+
+    nodes = [root_node(training_data, k)]
+    depth = 0
+    while depth < k and 0 < len(nodes) < 4 * n_jobs:
+        nodes = [child for node in nodes
+                 for child in expand_node(training_data, node, l, m)]
+        depth += 1
+
+    return nodes
+
+
+def get_leafs(training_data, l, k, m, n_jobs=1):
+    """
+    Return the leafs of the mismatch trie as a list, like `iter_leafs`.
+    With n_jobs > 1 the subtrees below the first levels are traversed
+    by a pool of processes.
+    """
+
+    if get_n_jobs(n_jobs) == 1:
+        return list(iter_leafs(training_data, l, k, m))
+
+    training_data = as_sequences(training_data)
+    nodes = split_nodes(training_data, l, k, m, get_n_jobs(n_jobs))
+    return [leaf for leafs in map_chunks(subtree_leafs, nodes, n_jobs,
+                                         (training_data, l, k, m))
+            for leaf in leafs]
+
+
+def subtree_leafs(nodes, training_data, l, k, m):
+    """
+    Return the leafs of the given subtrees as a list.
+    """
+
+    return list(iter_leafs(training_data, l, k, m, nodes))
+
+
+def subtree_kernel(nodes, training_data, l, k, m, dtype=np.float64):
+    """
+    Compute the partial kernel of the given subtrees in a new block of
+    shared memory, so that it does not have to be pickled to be sent back
+    to the calling process. The caller adds it to the kernel and unlinks it.
+    The partial kernel has the dtype of the caller's kernel, so a float32
+    buffer also halves the memory of every worker.
+
+    Returns
+    -------
+    name: str, name of the shared memory block holding the partial kernel
+    leafs: list of the leafs of the subtrees
+    """
+
+    from multiprocessing import shared_memory
+
+    n_samples = len(training_data.offsets) - 1
+    memory = shared_memory.SharedMemory(
+        create=True, size=max(n_samples * n_samples * np.dtype(dtype).itemsize, 1))
+    try:
+        kernel = np.ndarray((n_samples, n_samples), dtype=dtype,
+                            buffer=memory.buf)
+        kernel[:] = 0
+        leafs = add_leaf_batches(kernel, iter_leafs(training_data, l, k, m, nodes))
+        del kernel
+    except BaseException:
+        memory.close()
+        memory.unlink()
+        raise
+    memory.close()
+
+    return memory.name, leafs
+
+
+def unlink_shared_memory(name):
+    """
+    Remove the shared memory block name, if it still exists.
+    """
+
+    from multiprocessing import shared_memory
+
+    try:
+        memory = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    memory.close()
+    memory.unlink()
+
+
+def leaf_features(leafs, n_samples, l):
+    """
+    Build the explicit mismatch feature map from the leafs of the trie.
+
+    Parameters
+    ----------
+    leafs: iterable of (labels, samples, counts) as yielded by `iter_leafs`
+    n_samples: int, number of samples
+    l: int, size of alphabet
+
+    Returns
+    -------
+    features: sparse matrix of shape (n_samples, n_leafs) with the number of
+              k-mers of each sample at each leaf
+    codes: 1D int64 array, the labels of each leaf (column) read as a number
+           in base l, or 2D array of shape (n_leafs, k) with the labels
+           themselves if l**k does not fit into int64
+    """
+
+    kmers, indptr, indices, data = [], [0], [], []
+    for labels, samples, counts in leafs:
+        kmers.append(labels)
+        indices.append(samples)
+        data.append(counts)
+        indptr.append(indptr[-1] + len(samples))
+
+    # the leafs are collected column by column
+    features = csc_matrix((np.concatenate(data) if data else np.zeros(0, dtype=int),
+                           np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+                           indptr), shape=(n_samples, len(kmers)))
+    if not kmers:
+        return features.tocsr(), np.zeros(0, dtype=np.int64)
+    kmers = np.array(kmers, dtype=np.min_scalar_type(l - 1))
+    k = kmers.shape[1]
+    if int(l) ** k - 1 > np.iinfo(np.int64).max:
+        return features.tocsr(), kmers
+    return features.tocsr(), kmers @ l ** np.arange(k - 1, -1, -1, dtype=np.int64)
+
+
+def match_leafs(leaf_codes, codes):
+    """
+    Find the leafs `codes` among the sorted leafs `leaf_codes` of the
+    training samples, both as returned by `leaf_features`.
+
+    Returns
+    -------
+    columns: 1D array, the column of each leaf in leaf_codes
+    found: 1D boolean array, whether the leaf is part of leaf_codes
+    """
+
+    if len(leaf_codes) == 0 or len(codes) == 0:
+        return np.zeros(len(codes), dtype=np.int64), np.zeros(len(codes), dtype=bool)
+    # rows of labels are compared like tuples
+    leaf_codes, codes = _sortable(leaf_codes), _sortable(codes)
+    columns = np.searchsorted(leaf_codes, codes)
+    found = columns < len(leaf_codes)
+    found[found] = leaf_codes[columns[found]] == codes[found]
+    return columns, found
+
+
+def _sortable(codes):
+    if codes.ndim == 1:
+        return codes
+    codes = np.ascontiguousarray(codes)
+    return codes.view([('f%d' % i, codes.dtype) for i in range(codes.shape[1])]).ravel()
+
+
+def feature_leafs(features, codes, k, l):
+    """
+    Inverse of `leaf_features`: recover the leafs of the trie from the
+    explicit feature map, e.g. after loading it from a cache.
+
+    Parameters
+    ----------
+    features: sparse matrix of shape (n_samples, n_leafs)
+    codes: the leaf codes as returned by `leaf_features`
+    k: int, the k in 'k-mer'
+    l: int, size of alphabet
+
+    Returns
+    -------
+    leafs: list of (labels, samples, counts) in the order of the columns
+    """
+
+    features = features.tocsc()
+    leafs = []
+    for column, code in enumerate(np.asarray(codes).tolist()):
+        if isinstance(code, list):
+            labels = code
+        else:
+            labels = []
+            for _ in range(k):
+                code, label = divmod(code, l)
+                labels.append(label)
+            labels.reverse()
+        begin, end = features.indptr[column], features.indptr[column + 1]
+        leafs.append((labels, features.indices[begin:end],
+                      features.data[begin:end]))
+    return leafs
+
+
+def add_feature_kernel(kernel, features, block_size=1024):
+    """
+    Add features * features^T to kernel, block_size rows at a time.
+    """
+
+    features = csr_matrix(features)
+    transposed = features.T.tocsr()
+    for start in range(0, features.shape[0], block_size):
+        kernel[start:start + block_size] += (
+            features[start:start + block_size] @ transposed).toarray()
+    return kernel
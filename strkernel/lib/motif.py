@@ -2,6 +2,7 @@
 """
 Motif Module.
 """
+import numpy as np
 
 
 class Motif:
@@ -13,6 +14,9 @@ class Motif:
     2. The wildcard character "."
     3. Substiution groups that contain 2 ore more characters of the alphabet (e.g. [AG] or [CT]). "^" as a leading character
        indicates that every character in the alphabet but those in the substitution group matches this part of the motif.
+
+    For matching, a motif can be compiled (*compile*) into a boolean mask with one row per element and one column per
+    letter of an alphabet that is shared by a set of motifs.
     """
 
     def __init__(self, motif: str):
@@ -68,3 +72,37 @@ class Motif:
         stripped_motif = "".join(
             [c for c in self._orginal_motif if c not in "[]"])
         return set(stripped_motif)
+
+    def compile(self, alphabet: str) -> np.array:
+        """
+        Compiles the motif into a boolean mask of shape (length of the motif, length of the alphabet + 1). An entry is
+        True if the element of the motif matches the letter of the alphabet. The last column stands for all characters
+        which are not part of the alphabet.
+
+        Args:
+            **alphabet:** A string with the letters of all motifs that are matched together.
+
+        Returns:
+            Numpy array with the mask of the motif.
+        """
+        mask = np.zeros((len(self._motif), len(alphabet) + 1), dtype=bool)
+        for i, element in enumerate(self._motif):
+            mask[i] = self.element_mask(element, alphabet)
+        return mask
+
+    @staticmethod
+    def element_mask(element, alphabet: str, first: bool = False) -> np.array:
+        """
+        Returns the letters of the alphabet (and, as last entry, all other characters) that an element of a motif
+        matches. With *first*, a substitution group is tested as a substring of the letter, which is how the
+        MotifTrie matches the first element of a motif.
+        """
+        if element == ".":
+            return np.ones(len(alphabet) + 1, dtype=bool)
+        if isinstance(element, set):
+            letters = [char in element for char in alphabet] + [False]
+        elif first:
+            letters = [element in char for char in alphabet] + [element == ""]
+        else:
+            letters = [char in element for char in alphabet] + [False]
+        return np.array(letters, dtype=bool)
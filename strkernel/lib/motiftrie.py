@@ -6,6 +6,20 @@ Motif Trie Module
 from strkernel.lib.motif import Motif
 
 import numpy as np
+from scipy.sparse import csr_matrix
+
+# number of (position, trie node) pairs that are matched at once at the ends of the sequences
+END_BLOCK_SIZE = 2 ** 24
+
+
+def pack_bits(mask: np.array) -> np.array:
+    """
+    Packs a boolean array into an array of 64 bit words, padded with zeros.
+    """
+
+    packed = np.packbits(mask)
+    return np.concatenate([packed, np.zeros(-len(packed) % 8, dtype=np.uint8)]).view(np.uint64)
+
 
 class TrieNode:
     """
@@ -37,7 +51,8 @@ class MotifTrie:
     2. Each Motif object is added to the Trie by parsing the Trie and adding the parts of the Motif which are not yet present.
     3. The final Node object of each Motif is marked.
 
-    If sequences are passed to *check_for_motifs* function a DFS is performend and a numpy array containing the motif content is returned.
+    The motifs are also compiled into a bit-parallel automaton (*compile*), which finds all motifs in a single pass over a sequence.
+    If sequences are passed to *check_for_motifs* function the automaton is run and a numpy array containing the motif content is returned.
     """
 
     def __init__(self, motifs: [str]):
@@ -46,10 +61,94 @@ class MotifTrie:
         # build the trie object based on the given motifs
         for motif in motifs:
             self.add(Motif(motif))
+        self.compile()
+
+    def compile(self):
+        """
+        Compiles the motifs into masks over a shared alphabet (see *Motif.compile*) and into a bit-parallel (Shift-And)
+        automaton. Every element of every motif gets one bit of a state integer. After reading a character, the bit of
+        an element is set if the motif matches up to this element, so a single left-to-right pass over a sequence finds
+        all motifs at all positions. Sequences are matched as integer codes of the alphabet (see *encode*).
+        """
+
+        # count every motif once, in the order of the motif dict of check_for_motifs
+        self._motif_names = list(dict.fromkeys(self._motifs))
+        self.alphabet = "".join(sorted(set().union(*(Motif(name).get_alphabet() for name in self._motif_names))))
+        # the code of every byte, characters which are not part of the alphabet get the last code
+        self._table = np.full(256, len(self.alphabet), dtype=np.uint8 if len(self.alphabet) < 255 else np.uint16)
+        for code, char in enumerate(self.alphabet):
+            if ord(char) < 256:
+                self._table[ord(char)] = code
+
+        # motifs with the same elements end in the same node of the trie, which counts for the last of them
+        indices = {name: index for index, name in enumerate(self._motif_names)}
+        paths = {}
+        for name in self._motifs:
+            motif = Motif(name)
+            paths[tuple(frozenset(x) if isinstance(x, set) else x for x in motif._motif)] = (indices[name], motif)
+
+        self._masks = []
+        for index, motif in paths.values():
+            if motif._motif:
+                mask = motif.compile(self.alphabet)
+                mask[0] = Motif.element_mask(motif._motif[0], self.alphabet, first=True)
+                self._masks.append((index, mask))
+
+        # the automaton
+        self._starts = 0
+        self._finals = {}
+        bit = 0
+        for index, mask in self._masks:
+            self._starts |= 1 << bit
+            bit += len(mask)
+            self._finals[bit - 1] = (index, len(mask))
+        self._final_mask = sum(1 << bit for bit in self._finals)
+        self._depth = max((len(mask) for _, mask in self._masks), default=0)
+        rows = np.concatenate([mask for _, mask in self._masks]) if self._masks else np.zeros((0, len(self.alphabet) + 1), dtype=bool)
+        # the bits of the elements that match each code
+        self._code_masks = [int("0" + "".join("1" if x else "0" for x in column[::-1]), 2) for column in rows.T]
+
+        # the nodes of the trie in the order dfs visits them, with the index of their parent, their depth, their mask
+        # and the index of the motif that ends in them (-1 for none)
+        parents, depths, masks, node_motifs = [], [], [], []
+        stack = [(child, -1, 1) for child in self._root._children]
+        while stack:
+            node, parent, depth = stack.pop()
+            node._mask = Motif.element_mask(node._char, self.alphabet, depth == 1)
+            parents.append(parent)
+            depths.append(depth)
+            masks.append(node._mask)
+            node_motifs.append(indices[node._motif] if node._motif_finished else -1)
+            stack.extend((child, len(parents) - 1, depth + 1) for child in node._children)
+        self._node_parents = np.array(parents, dtype=np.int64)
+        self._node_depths = np.array(depths, dtype=np.int64)
+        self._node_masks = np.array(masks, dtype=bool).reshape(len(masks), len(self.alphabet) + 1)
+        self._node_motifs = np.array(node_motifs, dtype=np.int64)
+        # the children of every node (the root is the last node) as index ranges into _child_nodes
+        order = np.argsort(self._node_parents % (len(parents) + 1), kind='stable')
+        self._child_nodes = order
+        self._child_indptr = np.searchsorted(self._node_parents[order] % (len(parents) + 1), np.arange(len(parents) + 2))
+
+    def encode(self, sequence: str) -> np.array:
+        """
+        Converts a sequence into an array of the codes of its characters in the alphabet of the motifs.
+
+        Args:
+            **sequence:** A sequence (read).
+
+        Returns:
+            Numpy array with the code of every character, the length of the alphabet for characters which are not part
+            of the alphabet.
+        """
+
+        return self._table[np.frombuffer(str(sequence).encode('latin-1', 'replace'), dtype=np.uint8)]
 
     def check_for_motifs(self, sequence: str) -> np.array:
         """
         Iterates over the given sequence and returns the sum of the motif content of all subsequences.
+        The occurrences are found in a single pass of the compiled automaton. Only at the last positions, where
+        the longest motif does not fit anymore, the rule of *dfs* is applied (see *end_counts*) to keep the counts
+        identical.
 
         Args:
             **sequence:** A sequence (read) that only has characters that also appear in the alphabet of the motifs used to construct the MotifTrie.
@@ -58,25 +157,189 @@ class MotifTrie:
             Numpy array containing the motif content of the sequence.
         """
 
-        motifdict = {motif:0 for motif in self._motifs}
-        for i,c in enumerate(sequence):
-            motifdict = self.dfs(sequence[i:],motifdict)
+        counts = np.zeros(len(self._motif_names), dtype=int)
+        # start positions at which every motif fits into the sequence
+        last_start = len(sequence) - self._depth
+
+        state = 0
+        for end, code in enumerate(self.encode(sequence).tolist()):
+            state = ((state << 1) | self._starts) & self._code_masks[code]
+            hits = state & self._final_mask
+            while hits:
+                bit = (hits & -hits).bit_length() - 1
+                hits &= hits - 1
+                index, length = self._finals[bit]
+                if end - length + 1 <= last_start:
+                    counts[index] += 1
+
+        counts += self.end_counts(sequence[max(last_start + 1, 0):])
+
+        return counts
+
+    def end_counts(self, end: str) -> np.array:
+        """
+        Returns the motif content of the last positions of a sequence, where the longest motif does not fit
+        anymore. At these positions *dfs* stops at the first node without a motif that reaches the end of the
+        sequence, so only the motifs it visits before are counted (see *end_hits*).
+
+        Args:
+            **end:** The last (longest motif length - 1) characters of a sequence, or the whole sequence if it is shorter.
+
+        Returns:
+            Numpy array containing the motif content of the positions in the end.
+        """
+
+        codes = self._table[np.frombuffer(str(end).encode('latin-1', 'replace') + bytes(self._depth), dtype=np.uint8)]
+        positions = np.arange(len(end))
+        _, motifs = self.end_hits(codes, positions, len(end) - positions)
+        return np.bincount(motifs, minlength=len(self._motif_names)).astype(int)
+
+    def end_hits(self, codes: np.array, positions: np.array, remaining: np.array):
+        """
+        Applies the rule of *dfs* at many start positions at once. The nodes of the trie are matched level by level,
+        as (position, node) pairs: the children of the pairs of a level are kept if their mask allows the character
+        at their depth. *dfs* visits the nodes in a fixed order and stops at the first node without a motif whose
+        depth equals the number of characters left, so a motif is counted if its node matches and comes before it.
+
+        Args:
+            **codes:** Character codes (see *encode*), padded with at least (longest motif length) codes at the end.
+
+            **positions:** The start positions in *codes*.
+
+            **remaining:** The number of characters from each start position to the end of its sequence.
+
+        Returns:
+            Two numpy arrays, the index into *positions* and the motif index of every occurrence.
+        """
+
+        n_nodes = len(self._node_depths)
+        hits_positions, hits_motifs = [], []
+        block_size = max(END_BLOCK_SIZE // max(n_nodes, 1), 1)
+        for start in range(0, len(positions) if n_nodes else 0, block_size):
+            block = positions[start:start + block_size]
+            left = remaining[start:start + block_size]
+            # the pairs of the root, which is the last node
+            pairs = np.arange(len(block)), np.full(len(block), n_nodes)
+            matched_positions, matched_nodes = [], []
+            for depth in range(1, self._depth + 1):
+                index, nodes = pairs
+                begin, end = self._child_indptr[nodes], self._child_indptr[nodes + 1]
+                counts = end - begin
+                index = np.repeat(index, counts)
+                nodes = self._child_nodes[np.repeat(begin - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+                keep = self._node_masks[nodes, codes[block[index] + depth - 1]] & (left[index] >= depth)
+                pairs = index[keep], nodes[keep]
+                if not len(pairs[0]):
+                    break
+                matched_positions.append(pairs[0])
+                matched_nodes.append(pairs[1])
+            if not matched_positions:
+                continue
+            index, nodes = np.concatenate(matched_positions), np.concatenate(matched_nodes)
+            motifs = self._node_motifs[nodes]
+            # the first node at which dfs stops
+            stops = (motifs < 0) & (self._node_depths[nodes] == left[index])
+            first = np.full(len(block), n_nodes)
+            np.minimum.at(first, index[stops], nodes[stops])
+            counted = (motifs >= 0) & (nodes < first[index])
+            hits_positions.append(start + index[counted])
+            hits_motifs.append(motifs[counted])
+        if not hits_positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(hits_positions), np.concatenate(hits_motifs)
+
+    def count_motifs(self, sequences: [str], chunk_size: int = 2 ** 20, sparse: bool = False):
+        """
+        Computes the motif content of a batch of sequences at once. All sequences are concatenated into one array
+        of character codes, and every motif is tested at all positions as the AND of the allowed characters of its
+        elements over sliding windows. This is done in chunks of *chunk_size* characters. The counts are identical
+        to *check_for_motifs*.
+
+        Args:
+            **sequences:** A list of sequences (reads).
+
+            **chunk_size:** Number of characters that are processed at once. Default is 2 ** 20.
+
+            **sparse:** Option to return a csr_matrix, which is built without the dense matrix. Default is False.
+
+        Returns:
+            Numpy array (or csr_matrix) of shape (number of sequences, number of motifs) containing the motif content
+            of the sequences.
+        """
+
+        data = [str(sequence).encode('latin-1', 'replace') for sequence in sequences]
+        lengths = np.array([len(x) for x in data], dtype=np.int64)
+        n_motifs = len(self._motif_names)
+        # every occurrence is stored as the key sequence * n_motifs + motif
+        keys = []
+        # pad the characters, so that the windows at the end of the last chunk are complete
+        codes = self._table[np.frombuffer(b"".join(data) + bytes(self._depth), dtype=np.uint8)]
+        sequence_of = np.repeat(np.arange(len(data)), lengths)
+        # start positions at which every motif fits into its sequence
+        fits = np.repeat(lengths - self._depth + 1, lengths) > np.arange(len(sequence_of)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+
+        # the distinct rows of the masks, rows that match everything are skipped
+        rows = {}
+        motifs = []
+        for index, mask in self._masks:
+            elements = []
+            for position, row in enumerate(mask):
+                if not row.all():
+                    rows.setdefault(row.tobytes(), row)
+                    elements.append((position, row.tobytes()))
+            motifs.append((index, elements))
+
+        for start in range(0, len(sequence_of), chunk_size):
+            stop = min(start + chunk_size, len(sequence_of))
+            window = codes[start:stop + self._depth]
+            # the allowed characters of every row at every offset in the motif, as bits of 64 positions
+            allowed = {}
+            for key, row in rows.items():
+                matches = row[window]
+                for position in range(self._depth):
+                    allowed[key, position] = pack_bits(matches[position:position + stop - start])
+            fits_chunk = pack_bits(fits[start:stop])
+            hits = []
+            for index, elements in motifs:
+                hit = fits_chunk.copy()
+                for position, key in elements:
+                    hit &= allowed[key, position]
+                words = np.flatnonzero(hit)
+                if len(words):
+                    # positions of the set bits in the words that are not zero
+                    bits = np.unpackbits(hit[words].view(np.uint8).reshape(-1, 8), axis=1)
+                    words_, columns = np.nonzero(bits)
+                    hits.append(sequence_of[start + words[words_] * 64 + columns] * n_motifs + index)
+            keys.extend(hits)
+
+        # the occurrences at the last positions of every sequence, where the longest motif does not fit
+        tails = np.minimum(lengths, max(self._depth - 1, 0))
+        ends = np.cumsum(lengths)
+        positions = np.repeat(ends - np.cumsum(tails), tails) + np.arange(tails.sum())
+        rows, motifs = self.end_hits(codes, positions, np.repeat(ends, tails) - positions)
+        keys.append(sequence_of[positions[rows]] * n_motifs + motifs)
 
-        return np.fromiter(motifdict.values(), dtype=int)
+        keys, data = np.unique(np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64), return_counts=True)
+        counts = csr_matrix((data, (keys // max(n_motifs, 1), keys % max(n_motifs, 1))),
+                            shape=(len(sequences), n_motifs), dtype=np.int64)
 
+        return counts if sparse else counts.toarray()
 
     def dfs(self, sequence: str, motifdict: dict) -> [str]:
         """
         Performs a depth first search on the input sequence and adds the motif content to the input dictionary.
 
         Args:
-            **sequence:** A part of the sequence given to check_for_motifs. In the first iteration of check_for_motifs the complete sequence is passed to this function.
+            **sequence:** A part of the sequence given to check_for_motifs, as a string or as codes (see *encode*). In the first iteration of check_for_motifs the complete sequence is passed to this function.
             **motifdict:** A dictionary where each entry refers to one of the motifs used to construct the MotifTrie.
 
         Returns:
             The motifdict with the motif content in this specific sequence.
         """
 
+        if isinstance(sequence, str):
+            sequence = self.encode(sequence)
         node = self._root
         char_index = 0
         priolist = []
@@ -85,7 +348,7 @@ class MotifTrie:
             return False
 
         matching_childs = [(child, char_index)
-                           for child in node._children if child._char in sequence[char_index] or child._char == "."]
+                           for child in node._children if child._mask[sequence[char_index]]]
         priolist.extend(matching_childs)
 
         while priolist:
@@ -95,13 +358,15 @@ class MotifTrie:
             # check if current node is the end of a motif.
             if node._motif_finished:
                 motifdict[node._motif] += 1
+                if char_index == len(sequence):
+                    continue
             # check if end of the string is reached
             elif char_index == len(sequence):
                 return motifdict
 
             # fill priorityqueue with matching childs
             matching_childs = [(child, char_index)
-                               for child in node._children if sequence[char_index] in child._char or child._char == "."]
+                               for child in node._children if child._mask[sequence[char_index]]]
             priolist.extend(matching_childs)
 
         return motifdict
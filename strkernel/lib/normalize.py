@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''
+Normalize Module
+---
+Normalization of dense and sparse kernel matrices, shared by the kernels
+of the package.
+'''
+import warnings
+
+import numpy as np
+from scipy.sparse import issparse, SparseEfficiencyWarning
+
+
+def normalize_kernel(kernel, copy=True, block_size=1024):
+    """Normalize a kernel[x, y] by doing:
+    kernel[x, y] / sqrt(kernel[x, x] * kernel[y, y])
+    Entries with a zero diagonal are left unchanged and the diagonal is set
+    to 1, so the result stays exactly symmetric.
+
+    Parameters:
+    ----------
+    kernel:                 A square numpy array, np.memmap or scipy sparse
+                            matrix.
+    copy:                   Boolean. If False, a floating point kernel is
+                            normalized in place. True by default.
+    block_size:             Integer. Number of rows normalized at once, so
+                            that no temporary of the size of the kernel is
+                            needed. 1024 by default.
+    Returns:
+    -------
+    The normalized kernel, a csr matrix if the kernel is sparse.
+    """
+    assert kernel.ndim == 2
+    assert kernel.shape[0] == kernel.shape[1]
+
+    diagonal = np.array(kernel.diagonal(), dtype=np.float64)
+    kernel = _scale_kernel(kernel, diagonal, diagonal, copy, block_size)
+
+    # Set diagonal elements as 1
+    if issparse(kernel):
+        with warnings.catch_warnings():
+            # zero diagonal elements are not stored yet
+            warnings.simplefilter('ignore', SparseEfficiencyWarning)
+            kernel.setdiag(1.)
+    else:
+        np.fill_diagonal(kernel, 1.)
+    return kernel
+
+def normalize_test_kernel(kernel, test_diagonal, diagonal, copy=True, block_size=1024):
+    """Normalize a kernel[x, y] between test samples x and training samples y
+    by doing: kernel[x, y] / sqrt(test_diagonal[x] * diagonal[y])
+    where test_diagonal and diagonal are the kernel of each sample with itself.
+    Entries with a zero diagonal are left unchanged.
+
+    Parameters:
+    ----------
+    kernel:                 A numpy array, np.memmap or scipy sparse matrix
+                            of shape (n_test_samples, n_training_samples).
+    test_diagonal:          A numpy array of length n_test_samples.
+    diagonal:               A numpy array of length n_training_samples.
+    copy:                   Boolean. If False, a floating point kernel is
+                            normalized in place. True by default.
+    block_size:             Integer. Number of rows normalized at once.
+                            1024 by default.
+    Returns:
+    -------
+    The normalized kernel, a csr matrix if the kernel is sparse.
+    """
+    assert kernel.ndim == 2
+    assert kernel.shape == (len(test_diagonal), len(diagonal))
+
+    return _scale_kernel(kernel, np.asarray(test_diagonal, dtype=np.float64),
+                         np.asarray(diagonal, dtype=np.float64), copy, block_size)
+
+def _scale_kernel(kernel, row_diagonal, column_diagonal, copy, block_size):
+    """Divide kernel[x, y] by sqrt(row_diagonal[x] * column_diagonal[y]) where
+    this is positive, block_size rows at a time."""
+    if issparse(kernel):
+        if copy or kernel.format != 'csr' or not np.issubdtype(kernel.dtype, np.floating):
+            kernel = kernel.tocsr().astype(np.result_type(kernel.dtype, np.float32), copy=True)
+        for start in range(0, kernel.shape[0], block_size):
+            stop = min(start + block_size, kernel.shape[0])
+            begin, end = kernel.indptr[start], kernel.indptr[stop]
+            rows = np.repeat(np.arange(start, stop), np.diff(kernel.indptr[start:stop + 1]))
+            q = np.sqrt(row_diagonal[rows] * column_diagonal[kernel.indices[begin:end]])
+            block = kernel.data[begin:end]
+            np.divide(block, q, out=block, where=q > 0)
+        return kernel
+
+    if copy or not np.issubdtype(kernel.dtype, np.floating):
+        kernel = np.array(kernel, dtype=np.result_type(kernel.dtype, np.float32))
+    for start in range(0, kernel.shape[0], block_size):
+        stop = min(start + block_size, kernel.shape[0])
+        q = np.sqrt(np.outer(row_diagonal[start:stop], column_diagonal))
+        block = kernel[start:stop]
+        np.divide(block, q, out=block, where=q > 0, casting='unsafe')
+    return kernel
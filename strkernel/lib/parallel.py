@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+'''
+Parallel Module
+---
+Helper functions to distribute the sequences of a kernel computation over
+a pool of worker processes.
+'''
+import os
+import concurrent.futures
+
+
+def get_n_jobs(n_jobs):
+    """Return the number of worker processes to use. None means one process,
+    negative values count back from the number of cpus (-1 = all cpus)."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    if n_jobs == 0:
+        raise ValueError("n_jobs must not be 0.")
+    return n_jobs
+
+
+def split_chunks(n, n_chunks):
+    """Split range(n) into at most n_chunks contiguous (start, stop) pairs of
+    nearly equal size."""
+    n_chunks = max(min(n_chunks, n), 1)
+    bounds = [n * i // n_chunks for i in range(n_chunks + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def map_chunks(function, sequences, n_jobs=1, args=(), initializer=None, initargs=()):
+    """Apply function(chunk, *args) to contiguous chunks of the sequences, one
+    chunk per worker process, and return the results in the original order.
+    With a single job everything runs in the calling process.
+    initializer(*initargs) is called once in every worker process, so that
+    large objects the function needs are sent to each worker once instead of
+    with every chunk. It is not called with a single job, so it must not be
+    needed by function in the calling process.
+    """
+    n_jobs = get_n_jobs(n_jobs)
+    chunks = [sequences[start:stop] for start, stop in split_chunks(len(sequences), n_jobs)]
+    if n_jobs == 1:
+        return [function(chunk, *args) for chunk in chunks]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer,
+                                                initargs=initargs) as executor:
+        futures = [executor.submit(function, chunk, *args) for chunk in chunks]
+        return [future.result() for future in futures]
@@ -9,71 +9,53 @@
  <https://papers.nips.cc/paper/2179-mismatch-string-kernels-for-svm-protein-classification.pdf>
 """
 
-from strkernel.lib.mismatchTrie import MismatchTrie
+from strkernel.lib.cache import cached
+from strkernel.lib.encoding import (UNKNOWN, Sequences, alphabets, as_sequences, encode,
+                                     encode_batch, sequenceTypes)
+from strkernel.lib.mismatchTrie import (MismatchTrie, add_feature_kernel, feature_leafs,
+                                        get_leafs, leaf_features, match_leafs)
+from strkernel.lib.normalize import normalize_kernel, normalize_test_kernel
 import numpy as np
+from scipy.sparse import csr_matrix
+import warnings
 
 
-def integerized(sequence):
+def integerized(sequence, t=0):
     """
     Convert the character string into numeric string.
+    Every letter gets its fixed code in the alphabet t (see
+    `sequenceTypes`), so that all strings are encoded the same way.
+    Characters which are not part of the alphabet get the code 255, which
+    never matches a letter of the alphabet, and a warning is issued.
     """
 
-    key_dict = sorted(set(sequence))
-    int_seq = []
-    for char in sequence:
-        to_int = key_dict.index(char)
-        int_seq.append(to_int)
+    codes = encode(sequence, t)
+    _warn_unknown(codes, t)
+    return codes.tolist()
 
-    return int_seq
-
-def preprocess(sequences, ignoreLower=True):
+def preprocess(sequences, ignoreLower=True, t=0):
     """
     Data preprocessing for string sequences.
     Convert lower case into upper case if 'ignoreLower' is chosen as 'False',
     else lower case is ignored(default).
+    The sequences keep their lengths; the kernel uses all k-mers of each.
+    All sequences are encoded at once with the alphabet t (see
+    `sequenceTypes`, DNA by default). Letters which are not part of the
+    alphabet get the code 255 and a warning is issued.
     """
 
-    upper_seq = []
-    len_record = []
-    for seq in sequences:
-        if ignoreLower:
-            seq = [x for x in seq if 'A' <= x <= 'Z']
-        else:
-            seq = seq.upper()
-        upper_seq.append(integerized(seq))
-        len_record.append(len(seq))
-
-    length_used = min(len_record)
-    post_seq = []
-    for seq in upper_seq:
-        seq = seq[:length_used]
-        post_seq.append(seq)
-
-    return post_seq
-
-
-def normalize_kernel(kernel):
-    """
-    Normalizes a kernel[x, y] by doing:
-    kernel[x, y] / sqrt(kernel[x, x] * kernel[y, y])
-    """
-
-    nkernel = np.copy(kernel)
-
-    assert nkernel.ndim == 2
-    assert nkernel.shape[0] == nkernel.shape[1]
+    letters, offsets = encode_batch(sequences, t, include_flanking=not ignoreLower)
+    _warn_unknown(letters, t)
+    letters = letters.tolist()
+    return [letters[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
 
-    for i in range(nkernel.shape[0]):
-        for j in range(i + 1, nkernel.shape[0]):
-            q = np.sqrt(nkernel[i, i] * nkernel[j, j])
-            if q > 0:
-                nkernel[i, j] /= q
-                nkernel[j, i] = nkernel[i, j]  # symmetry
-
-    # Set diagonal elements as 1
-    np.fill_diagonal(nkernel, 1.)
-
-    return nkernel
+def _warn_unknown(letters, t):
+    n_unknown = np.count_nonzero(letters == UNKNOWN)
+    if n_unknown:
+        warnings.warn(
+            ("%d letters are not part of the alphabet %s (t = %d), they get "
+             "the code %d and never match.") % (n_unknown, alphabets[t], t, UNKNOWN),
+            stacklevel=3)
 
 
 class MismatchKernel(MismatchTrie):
@@ -87,11 +69,19 @@ class MismatchKernel(MismatchTrie):
        256: for data encoded as strings of bytes
        4: for DNA/RNA sequence (bioinformatics)
        20: for protein data (bioinformatics)
+       For sequences encoded by `preprocess`, l must be len(alphabets[t]).
     k: int, optional (default None), the k in 'k-mer'.
     m: int, optional (default None)
        maximum number of mismatches for 2 k-mers to be considered 'similar'.
        Normally small values of m should work well.
        Plus, the complexity of the algorithm is exponential in m.
+    n_jobs: int, optional (default 1)
+            number of processes the subtrees below the first levels of the
+            trie are distributed on, -1 uses all cpus.
+    cache: `strkernel.lib.cache.Cache` or path, optional (default None)
+           if given, the feature map of the samples is loaded from the
+           cache when it was computed for the same samples, l, k and m
+           before, instead of traversing the trie.
     **kwargs: dict, optional (default empty)
               optional parameters to pass to `tree.MismatchTrie` instantiation.
 
@@ -99,9 +89,19 @@ class MismatchKernel(MismatchTrie):
     ----------
     `kernel`: 2D array of shape (n_sampled, n_samples), estimated kernel.
     `n_survived_kmers`: number of leafs/k-mers that survived trie traversal.
+    `features`: sparse matrix of shape (n_samples, n_survived_kmers), the
+                explicit feature map of the training samples.
+    `leaf_codes`: 1D array, the k-mer of each column of `features` as a
+                  number in base l, or 2D array with the labels of the
+                  k-mers if l**k does not fit into int64.
+    The feature map of the training samples is also stored by `get_kernel`,
+    so that `get_test_kernel` can compute kernels for new samples.
     """
 
-    def __init__(self, l=None, k=None, m=None, **kwargs):
+    def __init__(self, l=None, k=None, m=None, n_jobs=1, cache=None, **kwargs):
+
+        self.n_jobs = n_jobs
+        self.cache = cache
 
         if not None in [l, k, m]:
 
@@ -123,35 +123,148 @@ class MismatchKernel(MismatchTrie):
             self.k = k
             self.m = m
 
-    def get_kernel(self, X, normalize = True, **kwargs):
+    def get_kernel(self, X, normalize = True, kernel = None, **kwargs):
         """
         Main calling function to get mismatch string kernel.
+        The kernel is written into `kernel` if it is given, e.g. a float32
+        array or a np.memmap of shape (n_samples, n_samples) filled with
+        zeros, and normalized in place. This way kernels larger than the
+        memory can be computed and loaded lazily afterwards.
         """
 
-        if isinstance(X, tuple):
+        if isinstance(X, tuple) and not isinstance(X, Sequences):
             assert len(X) == 5, "Invalid model."
             self.l, self.k, self.m, self.leaf_kmers, self.kernel = X
             # sanitize the types and shapes of self.l, self.j, self.m,
             # self.leaf_kmers, and self.kernel
         else:
             # traverse/build trie proper
-            for x in ['l', 'k', 'm']:
-                if not hasattr(self, x):
-                    raise RuntimeError(
-                        ("'%s' not specified during object initialization."
-                         "You must now specify complete model (tuple of l, "
-                         "k, m, leafs, and, kernel).") % x)
-            self.kernel, _, _ = self.traverse(
-                X, self.l, self.k, self.m, **kwargs)
+            self._check_parameters()
+            X = self._check_letters(as_sequences(X))
+            if self.cache is not None:
+                # the kernel is the product of the (cached) feature map
+                features, codes = self._leaf_features(X)
+                leafs = feature_leafs(features, codes, self.k, self.l)
+                n_samples = len(X.offsets) - 1
+                self.kernel = add_feature_kernel(
+                    np.zeros((n_samples, n_samples)) if kernel is None else kernel,
+                    features)
+                self.n_survived_kmers = len(leafs)
+            else:
+                self.kernel, self.n_survived_kmers, leafs = self.traverse_frontier(
+                    X, self.l, self.k, self.m, kernel=kernel, n_jobs=self.n_jobs,
+                    **kwargs)
 
             if normalize:
             # normalize kernel
-                self.kernel = normalize_kernel(self.kernel)
+                self.kernel = normalize_kernel(self.kernel, copy=False)
 
             # gather up the leafs
-            self.leaf_kmers = dict((leaf.full_label,
-                                    dict((index, len(kgs)) for index, kgs
-                                           in leaf.kmers.items()))
-                                     for leaf in self.leafs())
+            self.leaf_kmers = dict(("".join(str(label) for label in labels),
+                                    dict((int(index), int(count)) for index, count
+                                           in zip(samples, counts)))
+                                     for labels, samples, counts in leafs)
+
+            # keep the feature map for kernels of new samples
+            self.features, self.leaf_codes = leaf_features(
+                leafs, len(X.offsets) - 1, self.l)
 
         return self
+
+    def get_features(self, X):
+        """
+        Compute the explicit mismatch feature map of X instead of the kernel.
+        Each column holds the k-mer counts of one surviving leaf, so the
+        (unnormalized) kernel equals features * features^T. The sparse
+        matrix can be used directly with linear models, which avoids the
+        n_samples x n_samples kernel for large data sets.
+
+        Returns
+        -------
+        features: sparse matrix of shape (n_samples, n_survived_kmers)
+        """
+
+        self._check_parameters()
+        self.features, self.leaf_codes = self._leaf_features(
+            self._check_letters(as_sequences(X)))
+        self.n_survived_kmers = len(self.leaf_codes)
+
+        return self.features
+
+    def get_test_kernel(self, X, normalize = True):
+        """
+        Compute the kernel between new samples X and the samples the model
+        was computed for with `get_kernel` or `get_features`. Only X itself
+        is traversed; its k-mer counts are matched with the stored feature
+        map of the training samples and multiplied with it.
+
+        Returns
+        -------
+        kernel: 2D array of shape (n_test_samples, n_training_samples)
+        """
+
+        if not hasattr(self, 'features'):
+            raise RuntimeError(
+                "No feature map of training samples, call get_kernel or "
+                "get_features first.")
+
+        self._check_parameters()
+        X = self._check_letters(as_sequences(X))
+        n_samples = len(X.offsets) - 1
+        features, codes = leaf_features(
+            get_leafs(X, self.l, self.k, self.m, self.n_jobs), n_samples, self.l)
+
+        # move the columns of X to the leafs of the training samples,
+        # leafs that do not exist there do not contribute to the kernel
+        columns, found = match_leafs(self.leaf_codes, codes)
+        shared = features[:, np.flatnonzero(found)]
+        shared = csr_matrix((shared.data, columns[found][shared.indices],
+                             shared.indptr),
+                            shape=(n_samples, len(self.leaf_codes)))
+
+        kernel = (shared @ self.features.T).toarray().astype(float)
+
+        if normalize:
+            kernel = normalize_test_kernel(
+                kernel, features.multiply(features).sum(axis=1).A1,
+                self.features.multiply(self.features).sum(axis=1).A1, copy=False)
+
+        return kernel
+
+    def _leaf_features(self, X):
+        """
+        Traverse the trie for the flattened samples X and return their
+        feature map and leaf codes, from the cache if there is one.
+        """
+
+        def compute():
+            return leaf_features(get_leafs(X, self.l, self.k, self.m, self.n_jobs),
+                                 len(X.offsets) - 1, self.l)
+        return cached(self.cache, compute, 'mismatch_kernel.MismatchKernel',
+                      X, l=self.l, k=self.k, m=self.m)
+
+    def _check_letters(self, X):
+        """
+        Raise a ValueError if the samples X contain letters that are not
+        smaller than the alphabet size l. Letters that are not part of the
+        alphabet (code 255) are allowed, they never match.
+        """
+
+        letters = X.letters
+        if len(letters) and letters.max() >= self.l:
+            if self.l <= UNKNOWN:
+                letters = letters[letters != UNKNOWN]
+            if len(letters) and letters.max() >= self.l:
+                raise ValueError(
+                    ("The samples contain the letter %d, but l = %d. l must be "
+                     "the size of the alphabet the samples were encoded with, "
+                     "len(alphabets[t]).") % (letters.max(), self.l))
+        return X
+
+    def _check_parameters(self):
+        for x in ['l', 'k', 'm']:
+            if not hasattr(self, x):
+                raise RuntimeError(
+                    ("'%s' not specified during object initialization."
+                     "You must now specify complete model (tuple of l, "
+                     "k, m, leafs, and, kernel).") % x)
@@ -6,11 +6,32 @@ Motif Kernel Module.
 import re
 
 # own libraries
+from strkernel.lib.cache import cached
+from strkernel.lib.featurestore import FeatureStore
 from strkernel.lib.motiftrie import MotifTrie
+from strkernel.lib.normalize import normalize_kernel
+from strkernel.lib.parallel import get_n_jobs, map_chunks
 
 # 3rd party libraries
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
+
+# the motif trie of a worker process of the pool, set once by _init_worker
+_worker_trie = None
+
+
+def _init_worker(motif_trie):
+    global _worker_trie
+    _worker_trie = motif_trie
+
+
+def _count_chunk(sequences, include_flanking, motif_trie=None):
+    """Computes the motif content of a chunk of sequences with the given motif trie, or the one of the worker."""
+    if include_flanking:
+        sequences = [seq.upper() for seq in sequences]
+    else:
+        sequences = [re.sub('[^A-Z]', '', seq) for seq in sequences]
+    return (motif_trie or _worker_trie).count_motifs(sequences, sparse=True)
 
 
 class motifKernel:
@@ -30,7 +51,9 @@ class motifKernel:
     def __init__(self, motifs: [str]):
         self.motif_trie = motif_trie = MotifTrie(motifs)
 
-    def compute_matrix(self, sequences: [str], include_flanking: bool = True, return_kernel_matrix: bool = False):
+    def compute_matrix(self, sequences: [str], include_flanking: bool = True, return_kernel_matrix: bool = False,
+                       normalize: bool = False, block_size: int = None, out: np.ndarray = None,
+                       n_jobs: int = 1, cache=None):
         """
         Computes the motif content of a set of sequences and returns a sparse matrix which can be used as input
         for machine learning approaches. The sparse matrix has only been tested with algorithms from the python
@@ -43,19 +66,88 @@ class motifKernel:
 
             **return_kernel_matrix:** A boolean value that indicates if the function should return a sparse matrix with the similarities between sequences (True) or a sparse matrix where each row contains the motif content of a sequence (False). Default is False.
 
+            **normalize:** Option to normalize the kernel matrix, so that the similarity of each sequence with itself is 1. Only used if *return_kernel_matrix* is True. Default is False.
+
+            **block_size:** Number of rows of the kernel matrix that are computed at once. By default the kernel matrix is computed at once. Only used if *return_kernel_matrix* is True.
+
+            **out:** A dense array of shape (number of sequences, number of sequences), for example a np.memmap, which the kernel matrix is written to block by block. It is returned instead of a sparse matrix. Only used if *return_kernel_matrix* is True.
+
+            **n_jobs:** Number of processes the sequences are distributed on in contiguous chunks. The motif trie is sent to every process once. -1 uses all cpus. Default is 1.
+
+            **cache:** A *strkernel.lib.cache.Cache* or the path of its directory. If given, the motif content is loaded from the cache when it was computed for the same sequences, motifs and *include_flanking* before. Default is None.
+
         Returns:
             **csr_matrix:** A sparse matrix object containg either the kernel matrix (*return_kernel_matrix* = True) or
-            the motif content of each sequence.
+            the motif content of each sequence. If *out* is given, the kernel matrix is returned in *out*.
         """
-        if include_flanking:
-            sequences = [seq.upper() for seq in sequences]
-        else:
-            sequences = [re.sub('[^A-Z]', '', seq) for seq in sequences]
-
-        search_results = [self.motif_trie.check_for_motifs(sequence) for sequence in sequences]
+        def compute():
+            if get_n_jobs(n_jobs) == 1:
+                # the calling process uses the trie directly, only the pool sets the worker global
+                blocks = [_count_chunk(sequences, include_flanking, self.motif_trie)]
+            else:
+                blocks = map_chunks(_count_chunk, sequences, n_jobs, (include_flanking,),
+                                    initializer=_init_worker, initargs=(self.motif_trie,))
+            return vstack(blocks, format='csr')
+        search_results = cached(cache, compute, 'motifkernel.motifKernel', sequences,
+                                motifs=list(self.motif_trie._motifs), include_flanking=include_flanking)
 
         if return_kernel_matrix:
-            kernel_matrix = csr_matrix(np.einsum('ij,kj->ik', search_results,search_results))
+            kernel_matrix = self.kernel_matrix(search_results, block_size, out)
+            if normalize:
+                kernel_matrix = normalize_kernel(kernel_matrix, copy=False)
             return kernel_matrix
         else:
-            return csr_matrix(search_results)
+            return search_results
+
+    def compute_stream(self, batches, store, include_flanking: bool = True, n_jobs: int = 1):
+        """
+        Computes the motif content of sequences that are given in batches, for example by
+        *strkernel.lib.fasta.iter_sequences*, and appends it to a FeatureStore on disk batch by batch, so that only
+        one batch is kept in memory at a time.
+
+        Args:
+            **batches:** An iterable of lists of strings.
+
+            **store:** A FeatureStore or the path of its directory. The rows are appended to the rows it contains.
+
+            **include_flanking:** Option to include or disregard the flanking regions. Default is True.
+
+            **n_jobs:** Number of processes the sequences of every batch are distributed on. Default is 1.
+
+        Returns:
+            **FeatureStore:** The store with the motif content of all sequences, the number of sequences
+            containing each motif (*document_frequency*) and the norm of every row (*norms*).
+        """
+        if not isinstance(store, FeatureStore):
+            store = FeatureStore(store)
+        return store.extend(self.compute_matrix(batch, include_flanking=include_flanking, n_jobs=n_jobs)
+                            for batch in batches)
+
+    @staticmethod
+    def kernel_matrix(motif_content: csr_matrix, block_size: int = None, out: np.ndarray = None):
+        """
+        Computes the kernel matrix as the sparse product of the motif content with itself.
+
+        Args:
+            **motif_content:** A sparse matrix where each row contains the motif content of a sequence.
+
+            **block_size:** Number of rows of the kernel matrix that are computed at once. By default all rows are computed at once.
+
+            **out:** A dense array of shape (number of sequences, number of sequences), for example a np.memmap, which the kernel matrix is written to.
+
+        Returns:
+            **csr_matrix:** The kernel matrix, or *out* if it is given.
+        """
+        n = motif_content.shape[0]
+        block_size = block_size or max(n, 1)
+        transposed = motif_content.T.tocsr()
+        blocks = []
+        for start in range(0, n, block_size):
+            block = motif_content[start:start + block_size] @ transposed
+            if out is not None:
+                out[start:start + block_size] = block.toarray()
+            else:
+                blocks.append(block)
+        if out is not None:
+            return out
+        return vstack(blocks, format='csr') if blocks else csr_matrix((n, n), dtype=motif_content.dtype)
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import numpy as np
+import unittest
+
+from scipy.sparse import csr_matrix
+from strkernel.gappy_kernel import gappypair_kernel
+from strkernel.lib.cache import Cache
+from strkernel.mismatch_kernel import MismatchKernel, preprocess
+from strkernel.motifkernel import motifKernel
+from unittest import TestCase
+
+
+class Test_Cache(TestCase):
+    sequences = ["ACGTCGATGC", "GTCGATAGC", "GTCGaaagATAGC", "TTGACAGT"]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = Cache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_load(self):
+        key = self.cache.key('test', self.sequences, k=1)
+        self.assertEqual(key, self.cache.key('test', list(self.sequences), k=1))
+        self.assertNotEqual(key, self.cache.key('test', self.sequences, k=2))
+        self.assertNotEqual(key, self.cache.key('test', self.sequences[:3], k=1))
+        self.assertIsNone(self.cache.load(key))
+
+        matrix = csr_matrix([[1, 0], [0, 2]]).tocsc()
+        self.cache.save(key, (matrix, np.arange(3)))
+        loaded, codes = self.cache.load(key)
+        self.assertEqual('csc', loaded.format)
+        self.assertTrue(np.array_equal(matrix.toarray(), loaded.toarray()))
+        self.assertTrue(np.array_equal(np.arange(3), codes))
+
+    def test_eviction(self):
+        for i in range(3):
+            self.cache.save(str(i), np.zeros(1000))
+            os.utime(os.path.join(self.directory.name, str(i) + '.npz'), (i, i))
+        # loading marks a result as recently used
+        self.cache.load('0')
+        size = os.path.getsize(os.path.join(self.directory.name, '0.npz'))
+        Cache(self.directory.name, max_bytes=2 * size).evict()
+        self.assertEqual(['0.npz', '2.npz'], sorted(os.listdir(self.directory.name)))
+
+    def test_kernels(self):
+        expected = gappypair_kernel(self.sequences, k=1, g=1)
+        gappypair_kernel(self.sequences, k=1, g=1, cache=self.cache)
+        self.assertEqual(1, len(os.listdir(self.directory.name)))
+        cached = gappypair_kernel(self.sequences, k=1, g=1, cache=self.directory.name)
+        self.assertTrue(np.array_equal(expected.toarray(), cached.toarray()))
+
+        X = preprocess(self.sequences)
+        expected = MismatchKernel(l=4, k=3, m=1).get_kernel(X)
+        MismatchKernel(l=4, k=3, m=1, cache=self.cache).get_kernel(X)
+        cached = MismatchKernel(l=4, k=3, m=1, cache=self.cache).get_kernel(X)
+        self.assertTrue(np.allclose(expected.kernel, cached.kernel))
+        self.assertEqual(expected.leaf_kmers, cached.leaf_kmers)
+
+        kernel = motifKernel(["A[CG]T", "C.G", "G[A][AT]"])
+        expected = kernel.compute_matrix(self.sequences)
+        kernel.compute_matrix(self.sequences, cache=self.cache)
+        cached = kernel.compute_matrix(self.sequences, cache=self.cache)
+        self.assertTrue(np.array_equal(expected.toarray(), cached.toarray()))
+        self.assertEqual(3, len(os.listdir(self.directory.name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import io
+import os
+import tempfile
+import numpy as np
+import unittest
+
+from strkernel.lib.encoding import encode_batch
+from strkernel.lib.fasta import iter_sequences, read_batches, read_sequences
+from unittest import TestCase
+
+
+class Test_Fasta(TestCase):
+    fasta = b">seq1 first\nACGTac\ngtNN\n>seq2\r\nttAC\r\n>seq3\n\n>seq4\nGGGG\n"
+    sequences = ['ACGTacgtNN', 'ttAC', '', 'GGGG']
+
+    def test_read_sequences(self):
+        self.assertEqual(self.sequences, read_sequences(io.BytesIO(self.fasta)))
+        self.assertEqual(['ACGT', 'ggA', 'T'], read_sequences(io.BytesIO(b"\nACGT\n\nggA\nT")))
+        self.assertEqual([], read_sequences(io.BytesIO(b"")))
+
+    def test_small_blocks(self):
+        for block_size in (1, 3, 8, 1024):
+            self.assertEqual(self.sequences, read_sequences(io.BytesIO(self.fasta), block_size=block_size))
+
+    def test_read_batches(self):
+        batches = list(read_batches(io.BytesIO(self.fasta), batch_size=3, block_size=5))
+        self.assertEqual([3, 1], [len(batch.names) for batch in batches])
+        self.assertEqual(['seq1 first', 'seq2', 'seq3', 'seq4'], batches[0].names + batches[1].names)
+
+        expected = encode_batch(self.sequences[:3])
+        self.assertTrue(np.array_equal(expected.letters, batches[0].sequences.letters))
+        self.assertTrue(np.array_equal(expected.offsets, batches[0].sequences.offsets))
+        self.assertTrue(np.array_equal([0, 0, 0, 0, 1, 1, 1, 1, 0, 0, 1, 1, 0, 0], batches[0].flanks))
+
+    def test_iter_sequences(self):
+        batches = list(iter_sequences(io.BytesIO(self.fasta), batch_size=3))
+        self.assertEqual([self.sequences[:3], self.sequences[3:]], batches)
+
+    def test_read_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sequences.fasta')
+            with open(path, 'wb') as f:
+                f.write(self.fasta)
+            self.assertEqual(self.sequences, read_sequences(path))
+            batches = list(read_batches(path, t=None))
+            self.assertEqual(b"ACGTacgtNNttACGGGG", batches[0].sequences.letters.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import numpy as np
+import unittest
+
+from scipy.sparse import csr_matrix
+from strkernel.gappy_kernel import gappypair_kernel, gappypair_stream
+from strkernel.lib.featurestore import FeatureStore
+from strkernel.motifkernel import motifKernel
+from unittest import TestCase
+
+
+class Test_Feature_Store(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append(self):
+        path = os.path.join(self.directory.name, 'store')
+        store = FeatureStore(path)
+        store.append(csr_matrix([[1, 0, 2], [0, 0, 0]]))
+        store.append(np.array([[0, 3, 4]]))
+        self.assertEqual((3, 3), store.shape)
+        self.assertTrue(np.array_equal([[1, 0, 2], [0, 0, 0], [0, 3, 4]], store.to_csr().toarray()))
+        self.assertTrue(np.array_equal([[1, 1, 2]], store.document_frequency.toarray()))
+        self.assertTrue(np.allclose([np.sqrt(5), 0, 5], store.norms))
+
+        # rows are appended to an existing store
+        store = FeatureStore(path).append(csr_matrix([[0, 0, 1]]))
+        self.assertEqual(4, len(store))
+        self.assertTrue(np.array_equal([[1, 1, 3]], store.document_frequency.toarray()))
+        self.assertEqual([2, 2], [block.shape[0] for block in store.iter_blocks(2)])
+        with self.assertRaises(ValueError):
+            store.append(csr_matrix((1, 4)))
+
+    def test_interrupted_append(self):
+        path = os.path.join(self.directory.name, 'store')
+        FeatureStore(path).append(csr_matrix([[1, 0, 2]]))
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = f.read()
+        # the block is written, but the size of the store is not updated
+        FeatureStore(path).append(csr_matrix([[0, 9, 0]]))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            f.write(meta)
+        # stray bytes of a block that was only partially written
+        with open(os.path.join(path, 'data.bin'), 'ab') as f:
+            f.write(np.array([7.0]).tobytes())
+
+        store = FeatureStore(path)
+        self.assertEqual(1, len(store))
+        self.assertTrue(np.array_equal([[1, 0, 1]], store.document_frequency.toarray()))
+        store.append(csr_matrix([[0, 0, 3]]))
+        store = FeatureStore(path)
+        self.assertTrue(np.array_equal([[1, 0, 2], [0, 0, 3]], store.to_csr().toarray()))
+        self.assertTrue(np.array_equal([[1, 0, 2]], store.document_frequency.toarray()))
+        self.assertTrue(np.allclose([np.sqrt(5), 3], store.norms))
+
+    def test_gappy_stream(self):
+        sequences = ["ACGTCGATGC", "GTCGATAGC", "GTCGaaagATAGC", "TTGACAGT", "AAAA"]
+        batches = (sequences[i:i + 2] for i in range(0, len(sequences), 2))
+        store = gappypair_stream(batches, os.path.join(self.directory.name, 'gappy'), k=1, g=1)
+        expected = gappypair_kernel(sequences, k=1, g=1)
+        self.assertEqual(expected.shape, store.shape)
+        self.assertTrue(np.array_equal(expected.toarray(), store.to_csr().toarray()))
+        self.assertTrue(np.array_equal((expected.toarray() > 0).sum(axis=0, keepdims=True),
+                                       store.document_frequency.toarray()))
+
+    def test_protein_stream(self):
+        # the spectrum has 20**8 * 2 columns, only those that occur are kept
+        sequences = ["MKVLATGHEW", "MKVLGTWQRS", "PLKVLATCDE"]
+        batches = (sequences[i:i + 2] for i in range(0, len(sequences), 2))
+        store = gappypair_stream(batches, os.path.join(self.directory.name, 'protein'), k=4, g=1, t=2)
+        expected = gappypair_kernel(sequences, k=4, g=1, t=2)
+        self.assertEqual(expected.shape, store.shape)
+        self.assertEqual(0, (expected != store.to_csr()).nnz)
+        columns, counts = np.unique(expected.tocsr().indices, return_counts=True)
+        frequency = store.document_frequency
+        self.assertTrue(np.array_equal(columns, frequency.indices))
+        self.assertTrue(np.array_equal(counts, frequency.data))
+
+    def test_motif_stream(self):
+        kernel = motifKernel(["A[CG]T", "C.G", "C..G.T", "G[A][AT]"])
+        sequences = ["ACGTCGATGC", "AGTCTGCTTGCT", "GAATCG", "cgACTGaa"]
+        store = kernel.compute_stream([sequences[:3], sequences[3:]], os.path.join(self.directory.name, 'motif'))
+        expected = kernel.compute_matrix(sequences)
+        self.assertTrue(np.array_equal(expected.toarray(), store.to_csr().toarray()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -69,3 +69,52 @@ class Test_Gappy_Kernel(TestCase):
         expected[0,182] = 1.0
 
         self.assertTrue(np.array_equal(expected, gappy_kernel))
+
+    def test_gappy_kernel_unknown_characters(self):
+        sequences = [Seq("ACGNTCG")]
+        gappy_kernel = gk(sequences,k=1,t=0,g=1, gapDifferent = False, sparse = False)
+        expected = np.array([[0,1,1,0,0,0,2,0,0,0,0,5,0,1,1,0]])
+        expected = expected.astype(float)
+
+        self.assertTrue(np.array_equal(expected, gappy_kernel))
+
+    def test_gappy_kernel_gapDifferent_reverse(self):
+        sequences = [Seq("ACGGTCGATT")]
+        gappy_kernel = gk(sequences,k=1,t=0,g=2, reverse = True, sparse = False)
+        expected = np.array([[1,2,0,1,0,1,2,0,2,0,0,0,0,0,0,0,0,2,1,0,2,0,1,0,0,1,0,0,0,0,0,0,0,1,3,0,0,1,0,0,0,1,0,0,1,0,0,0]])
+        expected = expected.astype(float)
+
+        self.assertTrue(np.array_equal(expected, gappy_kernel))
+
+    def test_gappy_kernel_sparse_large_k(self):
+        sequences = [Seq("ACGTCGATGCATCGATCGAT"), Seq("GTCGATAGCAAATTTCGCG")]
+        gappy_kernel = gk(sequences,k=6,t=0,g=3)
+
+        self.assertEqual(gappy_kernel.shape, (2, 4 * 4**12))
+        self.assertEqual(gappy_kernel.dtype, np.int32)
+        self.assertEqual(gappy_kernel.sum(), 9 + 6 * 3 + 8 + 5 * 3)
+
+    def test_gappy_kernel_n_jobs(self):
+        sequences = [Seq("ACGTCGATGC"), Seq("GTCGATAGC"), Seq("GTCGaaagATAGC"), Seq("ACGGTCGATT"), Seq("TTGCA")]
+        serial = gk(sequences,k=1,t=0,g=2)
+        parallel = gk(sequences,k=1,t=0,g=2, n_jobs = 2)
+        parallel_dense = gk(sequences,k=1,t=0,g=2, n_jobs = 2, sparse = False)
+
+        self.assertTrue(0 == (serial != parallel).getnnz())
+        self.assertTrue(np.array_equal(serial.toarray(), parallel_dense))
+
+    def test_gappy_kernel_hashed(self):
+        sequences = [Seq("ACGTCGATGC"), Seq("GTCGATAGC"), Seq("GTCGaaagATAGC")]
+        explicit = gk(sequences,k=1,t=0,g=1, gapDifferent = False, sparse = False)
+        hashed = gk(sequences,k=1,t=0,g=1, gapDifferent = False, n_features = 2**30)
+
+        self.assertEqual(hashed.shape, (3, 2**30))
+        for row in range(3):
+            self.assertEqual(sorted(abs(hashed[row].data)), sorted(explicit[row][explicit[row] > 0]))
+
+    def test_gappy_kernel_hashed_large_k(self):
+        sequences = [Seq("ACDEFGHIKLMNPQRSTVWYACDEFGHIK")]
+        hashed = gk(sequences,k=9,t=2,g=2, n_features = 1024, sparse = False)
+
+        self.assertEqual(hashed.shape, (1, 1024))
+        self.assertEqual(abs(hashed).sum(), 12 + 10 * 2)
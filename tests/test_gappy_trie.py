@@ -1,9 +1,13 @@
+import os
+import tempfile
+import warnings
 import numpy as np
 import unittest
 
 from Bio.Seq import Seq
 from scipy.sparse import csr_matrix
-from strkernel.gappy_trie import gappypair_kernel as gt
+from strkernel.gappy_kernel import gappypair_kernel as gk
+from strkernel.gappy_trie import gappypair_kernel as gt, encode_sequences, prepare_data, Vocabulary
 from unittest import TestCase
 
 
@@ -25,3 +29,91 @@ class Test_Gappy_Kernel(TestCase):
         expected = csr_matrix(expected)
 
         self.assertTrue(0 == (expected != csr_matrix(gappy_trie)).getnnz())
+
+    def test_gappy_trie_hashed(self):
+        sequences = [Seq("ACGTCGATGC"), Seq("GTCGATAGC"), Seq("GTCGaaagATAGC")]
+        gappy_trie = gt(sequences,k=1,t=0,g=1, gapDifferent = False, n_features = 16)
+        expected = gk(sequences,k=1,t=0,g=1, gapDifferent = False, n_features = 16)
+
+        self.assertEqual(gappy_trie.shape, (3, 16))
+        self.assertTrue(0 == (expected != csr_matrix(gappy_trie)).getnnz())
+
+    def test_gappy_trie_bigger_k(self):
+        sequences = [Seq("ACGTCGATGC"), Seq("GTCGATAGC"), Seq("GTCGaaagATAGC")]
+        gappy_trie = gt(sequences,k=2,t=0,g=2, gapDifferent = False)
+        expected = gk(sequences,k=2,t=0,g=2, gapDifferent = False).toarray()
+        # the trie only contains the k-mers that occur
+        expected = expected[:, expected.any(axis=0)]
+
+        self.assertTrue(np.array_equal(expected, gappy_trie.toarray()))
+
+    def test_gappy_trie_n_jobs(self):
+        sequences = [Seq("ACGTCGATGC"), Seq("GTCGATAGC"), Seq("GTCGaaagATAGC")]
+        serial = gt(sequences,k=2,t=0,g=1)
+        parallel = gt(sequences,k=2,t=0,g=1, n_jobs = 2)
+
+        self.assertEqual(serial.shape, parallel.shape)
+        self.assertTrue(0 == (csr_matrix(serial) != csr_matrix(parallel)).getnnz())
+
+    def test_prepare_data_different_lengths(self):
+        sequences = ["ACGTCGATGC", "GTCGaaagATAGC", "TT"]
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            data = prepare_data(sequences, 0)
+            flanking = prepare_data(sequences, 0, include_flanking = True)
+            trie = gt(sequences,k=1,t=0,g=1)
+        self.assertEqual([10, 9, 2], [len(x) for x in data])
+        self.assertEqual([10, 13, 2], [len(x) for x in flanking])
+        self.assertEqual(3, trie.shape[0])
+
+    def test_encode_sequences(self):
+        sequences = ["ACGTNCGATGC", "GTCGaaagATAGC", "TT"]
+        encoded = encode_sequences(sequences, 0)
+        self.assertEqual(np.uint8, encoded.letters.dtype)
+        self.assertEqual([0, 10, 19, 21], encoded.offsets.tolist())
+        self.assertEqual([x.tolist() for x in prepare_data(sequences, 0)],
+                         [encoded.letters[a:b].tolist() for a, b in zip(encoded.offsets[:-1], encoded.offsets[1:])])
+        self.assertTrue(np.array_equal(gt(sequences,k=1,t=0,g=1).toarray(), gt(encoded,k=1,t=0,g=1).toarray()))
+        with self.assertRaises(ValueError):
+            encode_sequences(sequences, 0, include_flanking = True)
+
+    def test_gappy_trie_vocabulary(self):
+        train = [Seq("ACGTCGATGC"), Seq("GTCGATAGC")]
+        test = [Seq("GTCGaaagATAGC"), Seq("TTTT")]
+        vocabulary = Vocabulary()
+        train_trie = gt(train,k=1,t=0,g=1, vocabulary = vocabulary)
+        test_trie = gt(test,k=1,t=0,g=1, vocabulary = vocabulary)
+        expected = gt(train + test,k=1,t=0,g=1, vocabulary = Vocabulary(vocabulary.keys))
+
+        self.assertTrue(np.array_equal(train_trie.toarray(), gt(train,k=1,t=0,g=1).toarray()))
+        self.assertEqual(train_trie.shape[1], test_trie.shape[1])
+        self.assertTrue(np.array_equal(expected.toarray()[2:], test_trie.toarray()))
+        self.assertEqual(test_trie.toarray()[1].sum(), 0)
+
+    def test_gappy_trie_vocabulary_empty_batch(self):
+        # a batch without any kmers leaves the vocabulary empty
+        vocabulary = Vocabulary()
+        empty = gt(["A", "C"],k=1,t=0,g=1, vocabulary = vocabulary)
+        self.assertEqual((2, 0), empty.shape)
+        self.assertIsNone(vocabulary.keys)
+        train = gt([Seq("ACGTCGATGC")],k=1,t=0,g=1, vocabulary = vocabulary)
+        self.assertTrue(np.array_equal(gt([Seq("ACGTCGATGC")],k=1,t=0,g=1).toarray(), train.toarray()))
+
+    def test_gappy_trie_vocabulary_parameters(self):
+        sequences = [Seq("ACGTCGATGC"), Seq("GTCGATAGC")]
+        vocabulary = Vocabulary()
+        gt(sequences,k=1,t=0,g=1, vocabulary = vocabulary)
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'vocabulary.npz')
+            vocabulary.save(fname)
+            loaded = Vocabulary.load(fname)
+        self.assertTrue(np.array_equal(vocabulary.keys, loaded.keys))
+        self.assertEqual(vocabulary.parameters, loaded.parameters)
+        self.assertEqual(1, loaded.parameters['k'])
+
+        with self.assertRaises(ValueError):
+            gt(sequences,k=1,t=0,g=2, vocabulary = loaded)
+        with self.assertRaises(ValueError):
+            gt(sequences,k=1,t=0,g=1, gapDifferent = False, vocabulary = loaded)
+        with self.assertRaises(ValueError):
+            gt(sequences,k=1,t=0,g=1, n_features = 64, vocabulary = loaded)
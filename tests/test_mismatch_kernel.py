@@ -1,7 +1,16 @@
 from unittest import TestCase
+import os
+import tempfile
+import tracemalloc
 import unittest
 
-from strkernel.mismatch_kernel import preprocess, MismatchKernel
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from strkernel.mismatch_kernel import integerized, preprocess, normalize_kernel, MismatchKernel
+from strkernel.lib.encoding import alphabets, encode_batch, sequenceTypes
+from strkernel.lib.mismatchTrie import MismatchTrie
+import strkernel.lib.mismatchTrie
 import strkernel.mismatch_kernel
 
 class Test_Mismatch_Kernel(TestCase):
@@ -11,10 +20,25 @@ class Test_Mismatch_Kernel(TestCase):
     self.assertEqual(int_seq, [[0,0,1,2,3,3],[0,0,1,2,3,3]])
 
     # When ignoring lower case, the length of first string is 4,
-    # which is shorter than the 2nd string.
-    # The last 2 digits are ignored in this case.
+    # which is shorter than the 2nd string. Both keep their lengths.
     ignore_lower = preprocess(sequence)
-    self.assertEqual(ignore_lower, [[0,1,2,3],[0,0,1,2]])
+    self.assertEqual(ignore_lower, [[0,1,2,3],[0,0,1,2,3,3]])
+
+    # Every string is encoded with the same alphabet, letters outside of it
+    # are encoded with 255 and a warning
+    with self.assertWarns(UserWarning):
+      self.assertEqual(preprocess(['CGT', 'ACGT', 'TTNA']), [[1,2,3],[0,1,2,3],[3,3,255,0]])
+    with self.assertWarns(UserWarning):
+      self.assertEqual(integerized('ACGU'), [0,1,2,255])
+    self.assertEqual(preprocess(['ACGU'], t=sequenceTypes['rna']), [[0,1,2,3]])
+    self.assertEqual(preprocess([]), [])
+
+  def test_alphabet_size(self):
+    sequence = preprocess(['MKVLAT', 'MKVLGT'], t=sequenceTypes['aa'])
+    with self.assertRaises(ValueError):
+      MismatchKernel(l=4, k=3, m=1).get_kernel(sequence)
+    kernel = MismatchKernel(l=len(alphabets[sequenceTypes['aa']]), k=3, m=1).get_kernel(sequence)
+    self.assertEqual(kernel.kernel.shape, (2, 2))
 
   def test_kernel(self):
     sequence = ['ACGT', 'ACGT', 'CATG']
@@ -22,5 +46,121 @@ class Test_Mismatch_Kernel(TestCase):
     self.assertEqual(matrix.kernel[0,1], 1)
     self.assertLess(matrix.kernel[0,2], 1)
 
+  def test_traverse_frontier(self):
+    sequence = preprocess(['ACGTTGCA', 'ACGTACGT', 'CATGCATG', 'TTTTACGA'])
+    kernel, n_leafs, _ = MismatchTrie().traverse(sequence, 4, 3, 1)
+    frontier_kernel, frontier_n_leafs, leafs = MismatchTrie().traverse_frontier(sequence, 4, 3, 1)
+    self.assertTrue(np.array_equal(kernel, frontier_kernel))
+    self.assertEqual(n_leafs, frontier_n_leafs)
+    self.assertEqual(len(leafs), n_leafs)
+
+  def test_features(self):
+    sequence = preprocess(['ACGTTGCA', 'ACGTACGT', 'CATGCATG', 'TTTTACGA'])
+    mismatch_kernel = MismatchKernel(l=4, k=3, m=1)
+    features = mismatch_kernel.get_features(sequence)
+    kernel = mismatch_kernel.get_kernel(sequence, normalize=False).kernel
+    self.assertEqual(features.shape, (4, mismatch_kernel.n_survived_kmers))
+    self.assertTrue(np.array_equal((features @ features.T).toarray(), kernel))
+    self.assertEqual(len(mismatch_kernel.leaf_codes), len(mismatch_kernel.leaf_kmers))
+
+  def test_test_kernel(self):
+    sequence = preprocess(['ACGTTGCA', 'ACGTACGT', 'CATGCATG', 'TTTTACGA'])
+    kernel = MismatchKernel(l=4, k=3, m=1).get_kernel(sequence).kernel
+    test_kernel = MismatchKernel(l=4, k=3, m=1).get_kernel(sequence[:3]).get_test_kernel(sequence[3:])
+    self.assertEqual(test_kernel.shape, (1, 3))
+    self.assertTrue(np.allclose(test_kernel, kernel[3:, :3]))
+
+  def test_large_spectrum(self):
+    # 256**8 k-mers do not fit into int64 codes, the labels are kept instead
+    sequence = [np.frombuffer(x, dtype=np.uint8) for x in
+                [b'strkernel mismatch', b'mismatch kernels', b'gappy kernels', b'kernel mismatch']]
+    kernel = MismatchKernel(l=256, k=8, m=0).get_kernel(sequence).kernel
+    model = MismatchKernel(l=256, k=8, m=0).get_kernel(sequence[:3])
+    self.assertEqual(model.leaf_codes.shape, (model.n_survived_kmers, 8))
+    self.assertTrue(np.allclose(model.get_test_kernel(sequence[3:]), kernel[3:, :3]))
+    with tempfile.TemporaryDirectory() as directory:
+      MismatchKernel(l=256, k=8, m=0, cache=directory).get_kernel(sequence)
+      cached = MismatchKernel(l=256, k=8, m=0, cache=directory).get_kernel(sequence)
+    self.assertTrue(np.allclose(cached.kernel, kernel))
+    self.assertTrue(np.array_equal(cached.leaf_codes, MismatchKernel(l=256, k=8, m=0).get_kernel(sequence).leaf_codes))
+
+  def test_n_jobs(self):
+    sequence = preprocess(['ACGTTGCA', 'ACGTACGT', 'CATGCATG', 'TTTTACGA'])
+    mismatch_kernel = MismatchKernel(l=4, k=3, m=1).get_kernel(sequence)
+    parallel_kernel = MismatchKernel(l=4, k=3, m=1, n_jobs=2).get_kernel(sequence)
+    self.assertTrue(np.array_equal(mismatch_kernel.kernel, parallel_kernel.kernel))
+    self.assertEqual(mismatch_kernel.leaf_kmers, parallel_kernel.leaf_kmers)
+    self.assertTrue(np.allclose(parallel_kernel.get_test_kernel(sequence[:2]),
+                                mismatch_kernel.kernel[:2]))
+
+  @unittest.skipUnless(os.path.isdir('/dev/shm'), "needs /dev/shm")
+  def test_n_jobs_shared_memory(self):
+    # the partial kernels of the workers are released if adding them fails
+    sequence = preprocess(['ACGTTGCA', 'ACGTACGT', 'CATGCATG', 'TTTTACGA'])
+    blocks = set(os.listdir('/dev/shm'))
+    kernel = np.zeros((4, 4))
+    kernel.flags.writeable = False
+    with self.assertRaises(ValueError):
+      MismatchTrie().traverse_frontier(sequence, 4, 3, 1, kernel=kernel, n_jobs=2)
+    self.assertEqual(blocks, set(os.listdir('/dev/shm')))
+
+  def test_kernel_buffer(self):
+    sequence = preprocess(['ACGTTGCA', 'ACGTACGT', 'CATGCATG', 'TTTTACGA'])
+    kernel = MismatchKernel(l=4, k=3, m=1).get_kernel(sequence).kernel
+    buffer = np.zeros((4, 4), dtype=np.float32)
+    matrix = MismatchKernel(l=4, k=3, m=1).get_kernel(sequence, kernel=buffer)
+    self.assertIs(matrix.kernel, buffer)
+    self.assertTrue(np.allclose(buffer, kernel))
+
+  def test_kernel_buffer_memory(self):
+    # all samples share the leafs, so C^T C is dense
+    X = [list(x) for x in np.random.RandomState(0).randint(0, 4, (1000, 20))]
+    expected = MismatchTrie().traverse_frontier(X, 4, 3, 0)[0]
+    buffer = np.zeros((1000, 1000), dtype=np.float32)
+    block_size = strkernel.lib.mismatchTrie.KERNEL_BLOCK_SIZE
+    strkernel.lib.mismatchTrie.KERNEL_BLOCK_SIZE = 2 ** 14
+    tracemalloc.start()
+    try:
+      MismatchTrie().traverse_frontier(X, 4, 3, 0, kernel=buffer)
+      peak = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+      strkernel.lib.mismatchTrie.KERNEL_BLOCK_SIZE = block_size
+    self.assertTrue(np.array_equal(expected, buffer))
+    # the product is added block by block, so the traversal needs less
+    # memory than the buffer itself
+    self.assertLess(peak, buffer.nbytes)
+
+  def test_normalize_kernel(self):
+    features = np.array([[1, 2, 0], [0, 1, 1], [3, 0, 1]], dtype=float)
+    kernel = features @ features.T
+    normalized = normalize_kernel(kernel)
+    self.assertTrue(np.array_equal(normalize_kernel(kernel, block_size=2), normalized))
+    self.assertAlmostEqual(normalized[0, 1], 2 / np.sqrt(10))
+    self.assertEqual(kernel[0, 0], 5)
+    normalize_kernel(kernel, copy=False, block_size=1)
+    self.assertTrue(np.array_equal(kernel, normalized))
+    sparse = normalize_kernel(csr_matrix(features @ features.T), block_size=2)
+    self.assertTrue(np.array_equal(sparse.toarray(), normalized))
+
+  def test_different_lengths(self):
+    sequence = preprocess(['ACGTTGCAAC', 'ACGTA', 'CATGCATG'])
+    kernel = MismatchKernel(l=4, k=3, m=1).get_kernel(sequence, normalize=False).kernel
+    for i in range(3):
+      for j in range(3):
+        first, second = MismatchKernel(l=4, k=3, m=1), MismatchKernel(l=4, k=3, m=1)
+        first_features = first.get_features([sequence[i]]).toarray()[0]
+        second_features = second.get_features([sequence[j]]).toarray()[0]
+        shared, first_columns, second_columns = np.intersect1d(
+          first.leaf_codes, second.leaf_codes, return_indices=True)
+        self.assertEqual(kernel[i, j], np.dot(first_features[first_columns],
+                                              second_features[second_columns]))
+
+  def test_encoded_batch(self):
+    sequence = ['ACGTTGCA', 'ACGTA', 'CATGCATG']
+    kernel = MismatchKernel(l=4, k=3, m=1).get_kernel(preprocess(sequence)).kernel
+    batch = encode_batch(sequence)
+    self.assertTrue(np.array_equal(MismatchKernel(l=4, k=3, m=1).get_kernel(batch).kernel, kernel))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,12 @@
 from unittest import TestCase
+import pickle
 import numpy as np
 from scipy.sparse import csr_matrix
 
 from strkernel.lib.motif import Motif
 from strkernel.lib.motiftrie import MotifTrie
 from strkernel.motifkernel import motifKernel
+import strkernel.motifkernel
 
 
 class Test_Motif_Kernel(TestCase):
@@ -13,6 +15,13 @@ class Test_Motif_Kernel(TestCase):
         test_motif = Motif(motif)
         self.assertTrue(test_motif._motif == ["A", "CG", "T"])
 
+    def test_compiled_motif(self):
+        mask = Motif("A[CG].[^A]").compile("ACGT")
+        self.assertTrue(np.array_equal(mask, [[1, 0, 0, 0, 0],
+                                              [0, 1, 1, 0, 0],
+                                              [1, 1, 1, 1, 1],
+                                              [0, 1, 1, 0, 0]]))
+
     def test_trie(self):
         trie = MotifTrie(["A[CG]T", "C.G", "C..G.T", "G[A][AT]", "GT.A[CA].[CT]G"])
         self.assertTrue(np.array_equal(
@@ -32,3 +41,78 @@ class Test_Motif_Kernel(TestCase):
         data = np.array([1, 1, 1])
         matrix_2 = csr_matrix((data, (row, col)),shape = (5,4))
         self.assertTrue(np.array_equal(matrix_1.toarray(), matrix_2.toarray()))
+
+    def test_normalized_kernel(self):
+        motifs = ["A[CG]T", "C.G", "C..G.T", "G[A][AT]"]
+        sequences = ["ACGTCGATGC", "GTCGATAGC", "GCTAGCacgtaCGC",
+                     "GTAGCTgtgcGTGcgt", "CGATAGCTAGTTAGC"]
+
+        motif_kernel = motifKernel(motifs)
+        content = motif_kernel.compute_matrix(sequences).toarray()
+        kernel = motif_kernel.compute_matrix(
+            sequences, return_kernel_matrix=True, normalize=True).toarray()
+
+        norms = np.sqrt(np.sum(content * content, axis=1))
+        expected = content @ content.T / np.maximum(np.outer(norms, norms), 1)
+        np.fill_diagonal(expected, 1)
+        self.assertTrue(np.allclose(kernel, expected))
+
+    def test_trie_ends(self):
+        # motifs that are prefixes of each other, also at the end of the sequence
+        trie = MotifTrie(["AC", "ACG", "G[^C]C"])
+        self.assertTrue(np.array_equal(trie.check_for_motifs("TTACGACAC"), [3, 1, 0]))
+        self.assertTrue(np.array_equal(trie.check_for_motifs("AC"), [1, 0, 0]))
+
+    def test_end_counts(self):
+        # the vectorized end rule gives the counts of dfs at every start position
+        trie = MotifTrie(["AC", "ACG", "G[^C]C", "T.GA", "[AT]C", "CGTA"])
+        for end in ["ACG", "TAC", "GTC", "CGT", "A", "TTGA", "ACGTA"]:
+            motifdict = {motif: 0 for motif in trie._motif_names}
+            for i in range(len(end)):
+                motifdict = trie.dfs(end[i:], motifdict)
+            self.assertTrue(np.array_equal(trie.end_counts(end), list(motifdict.values())), end)
+
+    def test_trie_state(self):
+        # counting does not add state that is sent to every worker process
+        trie = MotifTrie(["A[CG]T", "C.G", "C..G.T"])
+        size = len(pickle.dumps(trie))
+        trie.count_motifs(["".join(np.random.RandomState(0).choice(list("ACGT"), 30)) for _ in range(100)])
+        self.assertEqual(size, len(pickle.dumps(trie)))
+
+    def test_count_motifs(self):
+        trie = MotifTrie(["A[CG]T", "C.G", "C..G.T", "G[A][AT]", "GT.A[CA].[CT]G", "AC", "ACG"])
+        sequences = ["AGTCTGCTTGCT", "ACGTCGATGC", "GTAGCTGTGCGTGCGTAC", "", "AC"]
+        counts = trie.count_motifs(sequences, chunk_size=7)
+        self.assertTrue(np.array_equal(
+            counts, [trie.check_for_motifs(sequence) for sequence in sequences]))
+
+    def test_blocked_kernel(self):
+        motifs = ["A[CG]T", "C.G", "C..G.T", "G[A][AT]"]
+        sequences = ["ACGTCGATGC", "GTCGATAGC", "GCTAGCacgtaCGC",
+                     "GTAGCTgtgcGTGcgt", "CGATAGCTAGTTAGC"]
+
+        motif_kernel = motifKernel(motifs)
+        content = motif_kernel.compute_matrix(sequences)
+        kernel = motif_kernel.compute_matrix(sequences, return_kernel_matrix=True)
+        self.assertTrue(np.array_equal(kernel.toarray(), (content @ content.T).toarray()))
+
+        blocked = motif_kernel.compute_matrix(sequences, return_kernel_matrix=True, block_size=2)
+        self.assertTrue(np.array_equal(blocked.toarray(), kernel.toarray()))
+
+        out = np.zeros((5, 5))
+        result = motif_kernel.compute_matrix(sequences, return_kernel_matrix=True, block_size=2, out=out)
+        self.assertIs(result, out)
+        self.assertTrue(np.array_equal(out, kernel.toarray()))
+
+    def test_n_jobs(self):
+        motifs = ["A[CG]T", "C.G", "C..G.T", "G[A][AT]"]
+        sequences = ["ACGTCGATGC", "GTCGATAGC", "GCTAGCacgtaCGC",
+                     "GTAGCTgtgcGTGcgt", "CGATAGCTAGTTAGC"]
+
+        motif_kernel = motifKernel(motifs)
+        for include_flanking in [True, False]:
+            matrix = motif_kernel.compute_matrix(sequences, include_flanking)
+            parallel = motif_kernel.compute_matrix(sequences, include_flanking, n_jobs=2)
+            self.assertTrue(np.array_equal(matrix.toarray(), parallel.toarray()))
+        # only the worker processes keep the trie in a global
+        self.assertIsNone(strkernel.motifkernel._worker_trie)